@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+""" Benchmark of the edge-to-database pipeline on synthetic edge streams
+
+Drives Ruler3D.event_handler with synthetic echo pulses for 3 and more lines
+(several stations of length/width/height), first as fast as possible, then at
+increasing event rates with a kernel-like event buffer to find where events are dropped.
+Results are written as JSON.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+from array import array
+
+import gpiod
+
+import r3d_journal
+import r3d_measure
+import r3d_writer
+import ruler3d
+
+AXES = (('length', 85.0), ('width', 47.0), ('height', 34.0))
+FIRST_LINE = 64
+
+
+class Latencies:
+    """ Preallocated latency log: recording allocates nothing, block counts are the pipeline's own """
+    def __init__(self, capacity=1 << 22):
+        self.values = array('q', bytes(8 * capacity))
+        self.count = 0
+
+    def append(self, value):
+        if self.count < len(self.values):
+            self.values[self.count] = value
+            self.count += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def list(self):
+        return self.values[:self.count].tolist()
+
+
+class NullSink:
+    """ Stands in for R3DWriter, a record is committed when put() """
+    def __init__(self):
+        self.fed_ns = 0
+        self.latencies = Latencies()
+        self.records = 0
+
+    def put(self, record):
+        self.latencies.append(time.perf_counter_ns() - self.fed_ns)
+        self.records += 1
+        return True
+
+    def drain(self):
+        """ Wait until the records put are committed """
+
+    def stop(self):
+        pass
+
+
+class JournalSink(NullSink):
+    """ Stands in for R3DWriter, a record is committed when its batch is in a local SQLite journal """
+    def __init__(self, path, batch_size=100, flush_interval=0.05):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=65536)
+        self.journal = r3d_journal.R3DJournal(path, r3d_writer.R3D_COLUMNS)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.running = True
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait((self.fed_ns, record))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _worker(self):
+        while self.running or not self.queue.empty():
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self.journal.append([(time.time(), record) for _, record in batch])
+                done_ns = time.perf_counter_ns()
+                self.latencies.extend(done_ns - fed_ns for fed_ns, _ in batch)
+                self.records += len(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    def drain(self):
+        self.queue.join()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.journal.close()
+
+
+class BenchRuler3D(ruler3d.Ruler3D):
+    def __init__(self, config, sink):
+        # no log_app / PG: a synthetic config and a fake sink instead of the database writer
+        self.config = config
+        self.writer = sink
+        self.publisher = None
+        self.sink = sink
+        self.setup_pipeline()
+
+
+def make_config(stations, base_config=None):
+    """ Config of stations S0, S1, ... on one chip, 3 lines each starting at FIRST_LINE """
+    config = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    if base_config:
+        config.read(base_config)
+    names = [f'S{station}' for station in range(stations)]
+    config.read_dict({'GPIO': {'chip_name': '/dev/null'}, 'trigger': {'enabled': 'no'},
+                      'stations': {'names': ','.join(names)}})
+    for station, station_name in enumerate(names):
+        config.read_dict({station_name: {}, f'{station_name}.scale': {'type': 'none'}})
+        for num, (name, base) in enumerate(AXES):
+            config.read_dict({f'{station_name}.{name}': {'line': str(FIRST_LINE + 3 * station + num),
+                                                         'base': str(base), 'name': name}})
+    return config
+
+
+def make_events(lines, cycles, seed=1):
+    """ Rising/falling edge pairs of all lines in turn, echo widths of random boxes with some noise """
+    rnd = random.Random(seed)
+    events = []
+    timestamp_ns = 0
+    seqno = 0
+    for _ in range(cycles):
+        for line_offset, base in lines:
+            dist_cm = base - rnd.uniform(0.3, 0.9) * base + rnd.gauss(0, 0.3)
+            width_ns = int(dist_cm * r3d_measure.NS_PER_CM)
+            for event_type, ts_ns in ((gpiod.EdgeEvent.Type.RISING_EDGE, timestamp_ns),
+                                      (gpiod.EdgeEvent.Type.FALLING_EDGE, timestamp_ns + width_ns)):
+                seqno += 1
+                events.append(gpiod.EdgeEvent(event_type=event_type.value, timestamp_ns=ts_ns,
+                                              line_offset=line_offset, global_seqno=seqno, line_seqno=seqno))
+            timestamp_ns += width_ns + 2_000_000
+    return events
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def noop(*_):
+    pass
+
+
+def run(callback, events, sink, duration, rate=0, buffer_size=1024, batch=False, alloc_baseline=0.0):
+    """
+    Feed events for duration seconds.
+
+    :param rate: Offered events per second, 0 is as fast as possible.
+    :param buffer_size: Events waiting beyond this are dropped, as by the kernel event FIFO.
+    :param batch: callback is a batch callback and events a numpy array of ruler3d.BATCH_DTYPE,
+                  each read batch is passed at once.
+    :param alloc_baseline: Allocated blocks per event of the harness itself (a run of noop), subtracted.
+    """
+    sink.latencies.clear()
+    records = sink.records
+    count = len(events)
+    idx = processed = dropped = 0
+    blocks = sys.getallocatedblocks()
+    start_ns = time.perf_counter_ns()
+    end_ns = start_ns + int(duration * 1e9)
+    while True:
+        now_ns = time.perf_counter_ns()
+        if now_ns >= end_ns:
+            break
+        if rate:
+            backlog = (now_ns - start_ns) * rate // 1_000_000_000 - processed - dropped
+            if backlog <= 0:
+                continue
+            if backlog > buffer_size:
+                dropped += backlog - buffer_size
+                idx += backlog - buffer_size
+                backlog = buffer_size
+        else:
+            backlog = 256
+        # one read_edge_events() batch
+        if batch:
+            sink.fed_ns = time.perf_counter_ns()
+            callback(events.take(range(idx, idx + backlog), mode='wrap'))
+            idx += backlog
+        else:
+            for _ in range(backlog):
+                event = events[idx % count]
+                idx += 1
+                sink.fed_ns = time.perf_counter_ns()
+                callback(event.line_offset, event)
+        processed += backlog
+    elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+    # records waiting in a sink queue are not growth of the pipeline
+    sink.drain()
+    blocks = sys.getallocatedblocks() - blocks
+    latencies = sink.latencies.list()
+    return {
+        'rate': rate,
+        'events': processed,
+        'dropped': dropped,
+        'events_per_sec': round(processed / elapsed),
+        'records': sink.records - records,
+        'latency_p50_us': None if not latencies else percentile(latencies, 50) / 1000,
+        'latency_p99_us': None if not latencies else percentile(latencies, 99) / 1000,
+        'alloc_blocks_per_event': round(blocks / max(processed, 1) - alloc_baseline, 4),
+    }
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stations', type=int, default=1, help='stations of 3 lines each')
+    parser.add_argument('--sink', choices=('null', 'journal'), default='null',
+                        help='null: commit on enqueue, journal: commit in a local SQLite journal')
+    parser.add_argument('--journal', default='bench-journal.sqlite', help='journal file of the journal sink')
+    parser.add_argument('--conf', help='take [estimator] and [stream] from this config')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per run')
+    parser.add_argument('--rates', help='comma separated events/sec, default doubles from 1000 until drops')
+    parser.add_argument('--buffer-size', type=int, default=1024, help='event buffer size')
+    parser.add_argument('--batch', action='store_true', help='batch callback, events as numpy arrays')
+    parser.add_argument('--output', default='bench_ruler3d.json', help='JSON result file')
+    args = parser.parse_args()
+
+    sink = JournalSink(args.journal) if args.sink == 'journal' else NullSink()
+    bench = BenchRuler3D(make_config(args.stations, args.conf), sink)
+    if args.batch:
+        callback = bench.chip_batch_callback(bench.chip_name)
+    else:
+        callback = bench.chip_callback(bench.chip_name)
+    lines = []
+    for station in bench.stations:
+        for line_offset, line in station.line_def.items():
+            lines.append((line_offset, line['base']))
+    events = make_events(lines, cycles=max(1000, 30000 // len(lines)))
+    if args.batch:
+        import numpy
+
+        events = numpy.array([(event.timestamp_ns, event.line_offset, event.event_type.value) for event in events],
+                             dtype=ruler3d.BATCH_DTYPE)
+
+    # block growth of the feeding loop alone, the results count the pipeline only
+    alloc_baseline = run(noop, events, sink, min(args.duration, 0.5), batch=args.batch)['alloc_blocks_per_event']
+    capacity = run(callback, events, sink, args.duration, batch=args.batch, alloc_baseline=alloc_baseline)
+    print(f"capacity: {capacity['events_per_sec']} events/sec", file=sys.stderr)
+    if args.rates:
+        rates = [int(rate) for rate in args.rates.split(',')]
+    else:
+        rates = [1000 << k for k in range(20) if 1000 << k < 4 * capacity['events_per_sec']]
+    results = []
+    breaking_point = None
+    for rate in rates:
+        result = run(callback, events, sink, args.duration, rate=rate, buffer_size=args.buffer_size,
+                     batch=args.batch, alloc_baseline=alloc_baseline)
+        results.append(result)
+        print(f"{rate} events/sec: dropped {result['dropped']}, p99 {result['latency_p99_us']} us", file=sys.stderr)
+        if result['dropped']:
+            breaking_point = rate
+            if not args.rates:
+                break
+    sink.stop()
+
+    report = {
+        'version': version(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stations': args.stations,
+        'lines': len(lines),
+        'sink': args.sink,
+        'batch': args.batch,
+        'buffer_size': args.buffer_size,
+        'alloc_baseline': alloc_baseline,
+        'capacity': capacity,
+        'rates': results,
+        'breaking_point': breaking_point,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'results saved to {args.output}', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,134 @@
+-- records, partitioned by month of ins_ts
 CREATE TABLE shp.ruler3d (
-	id serial NOT NULL,
+	id bigserial NOT NULL,
 	box_id varchar NOT NULL,
 	length numeric NULL,
 	width numeric NULL,
 	height numeric NULL,
+	weight numeric NULL,
+	station varchar NULL,
+	profile jsonb NULL, -- several sensors per axis: per axis min, max, sensor sizes and the height map
 	ins_ts timestamp without time zone DEFAULT now () NOT NULL,
-	CONSTRAINT ruler3d_pk PRIMARY KEY (id)
+	CONSTRAINT ruler3d_pk PRIMARY KEY (id, ins_ts)
+) PARTITION BY RANGE (ins_ts);
+
+-- rows outside of the monthly partitions are never rejected
+CREATE TABLE shp.ruler3d_default PARTITION OF shp.ruler3d DEFAULT;
+
+CREATE INDEX ruler3d_box_id_idx ON shp.ruler3d (box_id);
+CREATE INDEX ruler3d_station_ins_ts_idx ON shp.ruler3d (station, ins_ts);
+
+-- monthly partitions from the month of p_from (the current month by default) up to p_months ahead,
+-- run monthly (cron, pg_cron). Rows of a month already in the default partition (the job did not run
+-- for a while) are moved into its new partition: CREATE TABLE ... PARTITION OF would fail on them.
+CREATE OR REPLACE FUNCTION shp.ruler3d_add_partitions(p_months integer DEFAULT 3, p_from timestamp DEFAULT NULL)
+RETURNS void LANGUAGE plpgsql AS $$
+DECLARE
+	m date := date_trunc('month', least(p_from, now()::timestamp))::date;
+	last_month date := (date_trunc('month', now()) + make_interval(months => p_months))::date;
+	next_month date;
+	part text;
+BEGIN
+	WHILE m <= last_month LOOP
+		next_month := (m + interval '1 month')::date;
+		part := 'ruler3d_' || to_char(m, 'YYYYMM');
+		IF to_regclass(format('shp.%I', part)) IS NULL THEN
+			EXECUTE format('CREATE TABLE shp.%I (LIKE shp.ruler3d INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part);
+			EXECUTE format('WITH moved AS (DELETE FROM shp.ruler3d_default WHERE ins_ts >= %L AND ins_ts < %L '
+				'RETURNING *) INSERT INTO shp.%I SELECT * FROM moved', m, next_month, part);
+			EXECUTE format('ALTER TABLE shp.ruler3d ATTACH PARTITION shp.%I FOR VALUES FROM (%L) TO (%L)',
+				part, m, next_month);
+		END IF;
+		m := next_month;
+	END LOOP;
+END
+$$;
+
+SELECT shp.ruler3d_add_partitions();
+
+-- hourly rollup per station, sizes in cm, weight in kg
+CREATE TABLE shp.ruler3d_hourly (
+	hour timestamp without time zone NOT NULL,
+	station varchar NOT NULL,
+	boxes integer NOT NULL,
+	incomplete integer NOT NULL, -- a size missing or not positive
+	no_weight integer NOT NULL,
+	length_boxes integer NOT NULL, -- boxes with a length, the length statistics are over these
+	width_boxes integer NOT NULL,
+	height_boxes integer NOT NULL,
+	length_avg numeric(8,2) NULL,
+	length_p50 numeric(8,2) NULL,
+	length_p95 numeric(8,2) NULL,
+	width_avg numeric(8,2) NULL,
+	width_p50 numeric(8,2) NULL,
+	width_p95 numeric(8,2) NULL,
+	height_avg numeric(8,2) NULL,
+	height_p50 numeric(8,2) NULL,
+	height_p95 numeric(8,2) NULL,
+	weight_avg numeric(10,3) NULL,
+	weight_p50 numeric(10,3) NULL,
+	weight_p95 numeric(10,3) NULL,
+	CONSTRAINT ruler3d_hourly_pk PRIMARY KEY (hour, station)
 );
 
+-- recompute the rollup of the hours from p_from up to p_to
+CREATE OR REPLACE FUNCTION shp.ruler3d_rollup(p_from timestamp, p_to timestamp)
+RETURNS integer LANGUAGE plpgsql AS $$
+DECLARE
+	n integer;
+BEGIN
+	DELETE FROM shp.ruler3d_hourly WHERE hour >= date_trunc('hour', p_from) AND hour < p_to;
+	INSERT INTO shp.ruler3d_hourly
+	SELECT date_trunc('hour', ins_ts), coalesce(station, ''),
+		count(*),
+		count(*) FILTER (WHERE NOT coalesce(length > 0 AND width > 0 AND height > 0, false)),
+		count(*) FILTER (WHERE weight IS NULL),
+		count(*) FILTER (WHERE length > 0),
+		count(*) FILTER (WHERE width > 0),
+		count(*) FILTER (WHERE height > 0),
+		avg(length) FILTER (WHERE length > 0),
+		percentile_cont(0.5) WITHIN GROUP (ORDER BY length) FILTER (WHERE length > 0),
+		percentile_cont(0.95) WITHIN GROUP (ORDER BY length) FILTER (WHERE length > 0),
+		avg(width) FILTER (WHERE width > 0),
+		percentile_cont(0.5) WITHIN GROUP (ORDER BY width) FILTER (WHERE width > 0),
+		percentile_cont(0.95) WITHIN GROUP (ORDER BY width) FILTER (WHERE width > 0),
+		avg(height) FILTER (WHERE height > 0),
+		percentile_cont(0.5) WITHIN GROUP (ORDER BY height) FILTER (WHERE height > 0),
+		percentile_cont(0.95) WITHIN GROUP (ORDER BY height) FILTER (WHERE height > 0),
+		avg(weight),
+		percentile_cont(0.5) WITHIN GROUP (ORDER BY weight),
+		percentile_cont(0.95) WITHIN GROUP (ORDER BY weight)
+	FROM shp.ruler3d
+	WHERE ins_ts >= date_trunc('hour', p_from) AND ins_ts < p_to
+	GROUP BY 1, 2;
+	GET DIAGNOSTICS n = ROW_COUNT;
+	RETURN n;
+END
+$$;
+
+-- bring the rollup up to date: the last rolled up hour (it may have been partial) up to now,
+-- run every few minutes (cron: r3d_report.py refresh, or pg_cron)
+CREATE OR REPLACE FUNCTION shp.ruler3d_rollup_refresh()
+RETURNS integer LANGUAGE sql AS $$
+	SELECT shp.ruler3d_rollup(
+		coalesce((SELECT max(hour) FROM shp.ruler3d_hourly), (SELECT min(ins_ts) FROM shp.ruler3d), now()::timestamp),
+		now()::timestamp + interval '1 hour');
+$$;
+
+-- SELECT cron.schedule('ruler3d-rollup', '*/5 * * * *', 'SELECT shp.ruler3d_rollup_refresh()');
+-- SELECT cron.schedule('ruler3d-partitions', '0 0 1 * *', 'SELECT shp.ruler3d_add_partitions()');
+
+-- upgrade of an existing table
+-- ALTER TABLE shp.ruler3d ADD COLUMN weight numeric NULL;
+-- ALTER TABLE shp.ruler3d ADD COLUMN station varchar NULL;
+-- ALTER TABLE shp.ruler3d ADD COLUMN profile jsonb NULL;
+-- then move it into the partitioned table:
+-- ALTER TABLE shp.ruler3d RENAME TO ruler3d_old;
+-- ALTER TABLE shp.ruler3d_old RENAME CONSTRAINT ruler3d_pk TO ruler3d_old_pk;
+-- (the statements above)
+-- partitions for the whole history, or it all lands in the DEFAULT partition:
+-- SELECT shp.ruler3d_add_partitions(3, (SELECT min(ins_ts) FROM shp.ruler3d_old));
+-- INSERT INTO shp.ruler3d (box_id, length, width, height, weight, station, profile, ins_ts)
+--     SELECT box_id, length, width, height, weight, station, profile, ins_ts FROM shp.ruler3d_old;
+-- SELECT shp.ruler3d_rollup_refresh();
+-- DROP TABLE shp.ruler3d_old;
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+""" Calibration of base distances and the echo ns/cm factor from recorded edge events
+
+Takes edge recordings (ruler3d.py --record) of reference boxes of known size,
+one box at rest per recording (an empty table is a box of size 0), and fits
+per axis
+
+    size_cm = base_cm - width_ns / ns_per_cm
+
+by least squares over all echoes, optionally with ns_per_cm depending linearly
+on temperature. The result is written to the axis sections as integer
+base_ns and ns_per_cm, used as they are by r3d_measure.LineState.
+
+The reference file is CSV with a header:
+
+    recording,length,width,height[,temperature]
+
+with sizes in cm, an empty cell for an axis not measured in that recording.
+"""
+
+import argparse
+import configparser
+import csv
+import logging
+import re
+import sys
+
+import numpy
+
+import r3d_measure
+import r3d_record
+import r3d_station
+import ruler3d
+
+RISING = 1
+FALLING = 2
+
+
+def echo_widths(edges, line_offset, chip=0):
+    """
+    Echo pulse widths of a line, a rising edge followed by a falling edge, timeouts excluded.
+
+    :param edges: Structured array of r3d_record.EdgeFile.as_array().
+    :param chip: Chip index of the line in the recording.
+    :return: int64 array of widths, ns.
+    """
+    line = edges[(edges['line_offset'] == line_offset) & (edges['chip'] == chip)]
+    timestamps = line['timestamp_ns'].astype(numpy.int64)
+    event_types = line['event_type']
+    pairs = numpy.flatnonzero((event_types[:-1] == RISING) & (event_types[1:] == FALLING))
+    widths = timestamps[pairs + 1] - timestamps[pairs]
+    return widths[widths < r3d_measure.ECHO_TIMEOUT_NS]
+
+
+def read_reference(path):
+    """ Rows of the reference file as dicts, sizes and temperature as float or None """
+    with open(path, newline='') as file:
+        rows = []
+        for row in csv.DictReader(file):
+            rows.append({key: (value.strip() if key == 'recording' else
+                               float(value) if value and value.strip() else None)
+                         for key, value in row.items()})
+    return rows
+
+
+def collect(reference, axes, outlier_cm, chip=0):
+    """
+    Echo widths with the reference size and temperature of each, per axis.
+
+    :param axes: {axis name: line offset}.
+    :param chip: Chip index of the lines in the recordings.
+    :param outlier_cm: Echoes farther than this from the median of their recording are dropped, 0 keeps all.
+    :return: {axis name: (widths, sizes, temperatures)}, float64 arrays, temperatures None if not given.
+    """
+    samples = {axis: ([], [], []) for axis in axes}
+    for row in reference:
+        edges_file = r3d_record.EdgeFile(row['recording'])
+        try:
+            edges = edges_file.as_array()
+            for axis, line_offset in axes.items():
+                size = row.get(axis)
+                if size is None:
+                    continue
+                widths = echo_widths(edges, line_offset, chip)
+                if outlier_cm and len(widths):
+                    median = numpy.median(widths)
+                    widths = widths[numpy.abs(widths - median) <= outlier_cm * r3d_measure.NS_PER_CM]
+                logging.info('%s %s: %d echoes, size %s cm', row['recording'], axis, len(widths), size)
+                widths_list, sizes, temperatures = samples[axis]
+                widths_list.append(widths.astype(numpy.float64))
+                sizes.append(numpy.full(len(widths), size))
+                temperatures.append(numpy.full(len(widths), numpy.nan if row.get('temperature') is None
+                                               else row['temperature']))
+        finally:
+            del edges
+            edges_file.close()
+    result = {}
+    for axis, (widths, sizes, temperatures) in samples.items():
+        if not widths:
+            continue
+        temperatures = numpy.concatenate(temperatures)
+        result[axis] = (numpy.concatenate(widths), numpy.concatenate(sizes),
+                        None if numpy.isnan(temperatures).any() else temperatures)
+    return result
+
+
+def fit(widths, sizes, temperatures=None, temperature=None, ns_per_cm=None):
+    """
+    Least squares fit of size_cm = base_cm - width_ns * (k0 + k1 * (t - t_ref)), ns_per_cm = 1 / k.
+
+    :param temperatures: Temperature of each echo, None fits no temperature term.
+    :param temperature: Temperature to evaluate ns_per_cm at, the mean of temperatures by default.
+    :param ns_per_cm: Fixed factor, only the base is fitted, e.g. with a single reference size.
+    :return: dict of base_cm, ns_per_cm, rms_cm, samples and, with temperatures, ns_per_cm_per_c.
+    """
+    result = {'samples': len(widths)}
+    if ns_per_cm is not None:
+        base = numpy.mean(sizes + widths / ns_per_cm)
+        predicted = base - widths / ns_per_cm
+    elif temperatures is None:
+        design = numpy.column_stack((numpy.ones_like(widths), -widths))
+        (base, k0), *_ = numpy.linalg.lstsq(design, sizes, rcond=None)
+        ns_per_cm = 1 / k0
+        predicted = design @ (base, k0)
+    else:
+        t_ref = temperatures.mean()
+        if temperature is None:
+            temperature = t_ref
+        design = numpy.column_stack((numpy.ones_like(widths), -widths, -widths * (temperatures - t_ref)))
+        (base, k0, k1), *_ = numpy.linalg.lstsq(design, sizes, rcond=None)
+        ns_per_cm = 1 / (k0 + k1 * (temperature - t_ref))
+        # d(ns_per_cm)/dt at the evaluation temperature
+        result['ns_per_cm_per_c'] = -k1 * ns_per_cm ** 2
+        result['temperature'] = temperature
+        predicted = design @ (base, k0, k1)
+    result['base_cm'] = float(base)
+    result['ns_per_cm'] = float(ns_per_cm)
+    result['rms_cm'] = float(numpy.sqrt(numpy.mean((predicted - sizes) ** 2)))
+    return result
+
+
+def update_config(path, updates):
+    """
+    Set options in a config file in place, comments and layout kept.
+
+    :param updates: {section: {key: value}}, keys missing in a section are added after its last key.
+    """
+    with open(path) as file:
+        lines = file.read().splitlines()
+    pending = {section: dict(values) for section, values in updates.items()}
+    section = None
+    section_end = {}
+    for num, line in enumerate(lines):
+        match = re.match(r'\s*\[([^]]+)]', line)
+        if match:
+            section = match.group(1)
+            section_end[section] = num
+            continue
+        if section is None:
+            continue
+        match = re.match(r'(\s*)([^#;=\s]+)(\s*=\s*)([^#;]*?)(\s*[#;].*)?$', line)
+        if not match:
+            continue
+        # new keys go after the last active key, commented examples below it belong to the next section
+        section_end[section] = num
+        if match.group(2) in pending.get(section, {}):
+            value = pending[section].pop(match.group(2))
+            lines[num] = f'{match.group(1)}{match.group(2)}{match.group(3)}{value}{match.group(5) or ""}'
+    # append the rest, bottom up so the line numbers stay valid
+    for section, values in sorted(pending.items(), key=lambda item: section_end.get(item[0], -1), reverse=True):
+        if not values:
+            continue
+        if section not in section_end:
+            raise ValueError(f'no section [{section}] in {path}')
+        lines[section_end[section] + 1:section_end[section] + 1] = [f'{key}={value}' for key, value in values.items()]
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='\n'.join(__doc__.splitlines()[2:]))
+    parser.add_argument('reference', help='CSV of recordings and reference sizes')
+    parser.add_argument('--conf', default='ruler3d.conf', help='config with the axis sections')
+    parser.add_argument('--station', help='station name of a multi-station config')
+    parser.add_argument('--outlier-cm', type=float, default=3.0,
+                        help='drop echoes this far from the median of their recording, 0 keeps all')
+    parser.add_argument('--temperature', type=float,
+                        help='fit a temperature term and write ns_per_cm for this temperature, C')
+    parser.add_argument('--write', action='store_true', help='write base_ns and ns_per_cm to the config')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    config = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    config.read(args.conf)
+    prefix = f'{args.station}.' if args.station else ''
+    axes = {axis: config.getint(prefix + axis, 'line') for axis in r3d_station.AXES}
+    # recordings number the chips in the order of the stations using them
+    specs = ruler3d.Ruler3D.station_specs(config)
+    chip_names = list(dict.fromkeys(spec['chip_name'] for spec in specs))
+    chip = chip_names.index(next(spec['chip_name'] for spec in specs
+                                 if not args.station or spec['name'] == args.station))
+
+    samples = collect(read_reference(args.reference), axes, args.outlier_cm, chip)
+    updates = {}
+    for axis, (widths, sizes, temperatures) in samples.items():
+        if args.temperature is None:
+            temperatures = None
+        elif temperatures is None:
+            logging.warning('%s: temperature missing in the reference, no temperature term', axis)
+        fixed = None
+        if len(numpy.unique(sizes)) < 2:
+            fixed = config.getint(prefix + axis, 'ns_per_cm', fallback=config.getint(
+                'estimator', 'ns_per_cm', fallback=r3d_measure.NS_PER_CM))
+            logging.warning('%s: a single reference size, base only, ns_per_cm=%d kept', axis, fixed)
+        result = fit(widths, sizes, temperatures, args.temperature, ns_per_cm=fixed)
+        print(f"{axis}: base {result['base_cm']:.2f} cm, {result['ns_per_cm']:.1f} ns/cm, "
+              f"rms {result['rms_cm']:.3f} cm, {result['samples']} echoes"
+              + (f", {result['ns_per_cm_per_c']:.1f} ns/cm per C" if 'ns_per_cm_per_c' in result else ''))
+        ns_per_cm = int(round(result['ns_per_cm']))
+        updates[prefix + axis] = {'base': f"{result['base_cm']:.2f}",
+                                  'base_ns': int(round(result['base_cm'] * ns_per_cm)),
+                                  'ns_per_cm': ns_per_cm}
+    if not updates:
+        print('no echoes of the configured lines in the recordings', file=sys.stderr)
+        return 1
+    if args.write:
+        update_config(args.conf, updates)
+        print(f'written to {args.conf}', file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+""" Durable local journal of ruler3d records (SQLite in WAL mode) """
+
+import logging
+import sqlite3
+
+
+class R3DJournal:
+    def __init__(self, path, columns):
+        """
+        Open (create) the journal.
+
+        Records are appended in batches, one transaction and so one fsync per batch.
+        Replay progress is kept as a checkpoint, replayed records are pruned.
+
+        :param path: Journal file name.
+        :param columns: Record column names, in record tuple order.
+        """
+        self.path = path
+        self.columns = tuple(columns)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY, ts REAL NOT NULL, {})'.format(
+            ', '.join(self.columns)))
+        # journals written by an older version lack the newer columns
+        existing = {row[1] for row in self.db.execute('PRAGMA table_info(journal)')}
+        for column in self.columns:
+            if column not in existing:
+                self.db.execute(f'ALTER TABLE journal ADD COLUMN {column}')
+        self.db.execute('CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 1), '
+                        'last_seq INTEGER NOT NULL)')
+        self.db.execute('INSERT OR IGNORE INTO checkpoint (id, last_seq) VALUES (1, 0)')
+        self._ins_sql = 'INSERT INTO journal (ts, {}) VALUES (?, {})'.format(
+            ', '.join(self.columns), ', '.join('?' * len(self.columns)))
+        self._sel_sql = 'SELECT seq, ts, {} FROM journal WHERE seq > ? ORDER BY seq LIMIT ?'.format(
+            ', '.join(self.columns))
+        logging.info('journal %s opened, backlog=%d', path, self.backlog())
+
+    @property
+    def last_seq(self):
+        """ Last replayed seq """
+        return self.db.execute('SELECT last_seq FROM checkpoint WHERE id = 1').fetchone()[0]
+
+    def append(self, items):
+        """
+        Append records in a single transaction.
+
+        :param items: A list of (time.time() of the record, tuple in self.columns order) pairs.
+        """
+        self.db.execute('BEGIN')
+        try:
+            self.db.executemany(self._ins_sql, [(ts,) + tuple(rec) for ts, rec in items])
+        except sqlite3.Error:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def pending(self, limit):
+        """
+        Fetch not yet replayed records.
+
+        :param limit: Max number of records.
+        :return: A list of (seq, time.time() of the record, record) tuples.
+        """
+        rows = self.db.execute(self._sel_sql, (self.last_seq, limit)).fetchall()
+        return [(row[0], row[1], row[2:]) for row in rows]
+
+    def checkpoint(self, seq):
+        """
+        Mark records up to seq as replayed and prune them.
+
+        The row of seq itself is kept: seq is the rowid, SQLite numbers new rows from the highest
+        one present, a drained journal would start over below the checkpoint.
+        """
+        self.db.execute('BEGIN')
+        self.db.execute('UPDATE checkpoint SET last_seq = ? WHERE id = 1', (seq,))
+        self.db.execute('DELETE FROM journal WHERE seq < ?', (seq,))
+        self.db.execute('COMMIT')
+
+    def backlog(self):
+        """ Number of records waiting for replay """
+        return self.db.execute('SELECT count(*) FROM journal WHERE seq > ?', (self.last_seq,)).fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+""" Per-line HC-SR04 echo measurement """
+
+from array import array
+
+NS_PER_CM = 57720  # echo pulse width per cm of distance (57.72 us/cm), 58.8 in some datasheets
+ECHO_TIMEOUT_NS = 38_000_000  # the sensor drops the echo line after 38 ms when there is no echo
+
+# line states
+IDLE = 0
+WAIT_FALL = 1
+
+ESTIMATORS = ('median', 'trimmed', 'mean')
+
+
+class LineState:
+    """ Echo line state machine: rising edge -> falling edge -> sample """
+    __slots__ = ('offset', 'name', 'base_ns', 'ns_per_cm', 'state', 'rising_ns', 'samples', 'count', 'size_mm',
+                 'min_samples', 'tolerance_ns', 'outlier_ns', 'estimator', 'trim',
+                 'echoes', 'timeouts', 'no_rising', 'dup_rising', 'outliers', 'converged', 'exhausted', 'lost')
+
+    def __init__(self, offset, name, base_cm, samples=2, min_samples=2, tolerance_cm=0.0, outlier_cm=0.0,
+                 estimator='mean', trim=0.2, ns_per_cm=NS_PER_CM, base_ns=None):
+        """
+        Initialize the LineState.
+
+        A size is ready as soon as min_samples echoes (outliers excluded) agree within tolerance_cm,
+        otherwise after samples echoes, whatever their spread.
+
+        :param offset: Echo line offset.
+        :param name: Axis name.
+        :param base_cm: Distance from the sensor to the opposite side of an empty table.
+        :param samples: Max number of echoes per size.
+        :param min_samples: Min number of echoes per size.
+        :param tolerance_cm: Max spread of the echoes to stop early, 0 disables early stop.
+        :param outlier_cm: Echoes farther than this from the median are rejected, 0 keeps all.
+        :param estimator: 'median', 'trimmed' (mean) or 'mean'.
+        :param trim: Share of echoes cut off each end by the trimmed mean.
+        :param ns_per_cm: Echo pulse width per cm, integer ns, see r3d_calibrate.py.
+        :param base_ns: Calibrated base as echo pulse width, integer ns, overrides base_cm.
+        """
+        if estimator not in ESTIMATORS:
+            raise ValueError(f"Invalid estimator {estimator}. Use one of {ESTIMATORS}.")
+        if not 1 <= min_samples <= samples:
+            raise ValueError("Invalid samples. Use 1 <= min_samples <= samples.")
+        self.offset = offset
+        self.name = name
+        self.ns_per_cm = ns_per_cm
+        self.base_ns = base_ns if base_ns is not None else int(round(base_cm * ns_per_cm))
+        self.state = IDLE
+        self.rising_ns = 0
+        self.samples = array('q', bytes(8 * samples))
+        self.count = 0
+        self.size_mm = None
+        self.min_samples = min_samples
+        self.tolerance_ns = int(round(tolerance_cm * ns_per_cm))
+        self.outlier_ns = int(round(outlier_cm * ns_per_cm))
+        self.estimator = estimator
+        self.trim = trim
+        # counters
+        self.echoes = 0
+        self.timeouts = 0
+        self.no_rising = 0
+        self.dup_rising = 0
+        self.outliers = 0
+        self.converged = 0
+        self.exhausted = 0
+        self.lost = 0
+
+    def rising(self, timestamp_ns):
+        """Echo pulse started."""
+        if self.state == WAIT_FALL:
+            # the falling edge was lost, start over from this one
+            self.dup_rising += 1
+        self.state = WAIT_FALL
+        self.rising_ns = timestamp_ns
+
+    def falling(self, timestamp_ns):
+        """
+        Echo pulse ended.
+
+        :return: True when a new size is ready in self.size_mm.
+        """
+        if self.state != WAIT_FALL:
+            self.no_rising += 1
+            return False
+        self.state = IDLE
+        width_ns = timestamp_ns - self.rising_ns
+        if width_ns >= ECHO_TIMEOUT_NS:
+            self.timeouts += 1
+            return False
+        return self.echo(width_ns)
+
+    def echo(self, width_ns):
+        """
+        An echo pulse, paired and below the timeout.
+
+        :return: True when a new size is ready in self.size_mm.
+        """
+        self.echoes += 1
+        self.samples[self.count] = width_ns
+        self.count += 1
+        if self.count < self.min_samples:
+            return False
+        return self._estimate()
+
+    def _estimate(self):
+        """Stop sampling if the echoes agree or the buffer is full, set self.size_mm."""
+        count = self.count
+        widths = sorted(self.samples[:count])
+        mid = count // 2
+        median = widths[mid] if count % 2 else (widths[mid - 1] + widths[mid]) // 2
+        if self.outlier_ns:
+            kept = [width for width in widths if abs(width - median) <= self.outlier_ns]
+            if not kept:
+                kept = widths
+        else:
+            kept = widths
+        full = count == len(self.samples)
+        if self.tolerance_ns and len(kept) >= self.min_samples and kept[-1] - kept[0] <= self.tolerance_ns:
+            self.converged += 1
+        elif full:
+            self.exhausted += 1
+        else:
+            return False
+        self.outliers += count - len(kept)
+        self.count = 0
+
+        n = len(kept)
+        if self.estimator == 'median':
+            mid = n // 2
+            total = kept[mid] * 2 if n % 2 else kept[mid - 1] + kept[mid]
+            n = 2
+        else:
+            if self.estimator == 'trimmed':
+                cut = int(n * self.trim)
+                if cut and n - 2 * cut > 0:
+                    kept = kept[cut:n - cut]
+                    n = len(kept)
+            total = sum(kept)
+        # size = base - mean(distance), rounded to mm, in integer arithmetic
+        self.size_mm = ((self.base_ns * n - total) * 10 + self.ns_per_cm * n // 2) // (self.ns_per_cm * n)
+        return True
+
+    def size_of(self, width_ns):
+        """ Size of a single echo, mm, without the estimator """
+        return ((self.base_ns - width_ns) * 10 + self.ns_per_cm // 2) // self.ns_per_cm
+
+    def update(self, other):
+        """
+        Take over the settings of other (a LineState built from a reloaded config), keep the state.
+
+        An echo in flight and the samples taken so far are kept: with a smaller buffer the newest ones,
+        one slot left free for the next echo.
+        """
+        self.name = other.name
+        self.base_ns = other.base_ns
+        self.ns_per_cm = other.ns_per_cm
+        self.min_samples = other.min_samples
+        self.tolerance_ns = other.tolerance_ns
+        self.outlier_ns = other.outlier_ns
+        self.estimator = other.estimator
+        self.trim = other.trim
+        if len(other.samples) != len(self.samples):
+            count = min(self.count, len(other.samples) - 1)
+            samples = array('q', bytes(8 * len(other.samples)))
+            samples[:count] = self.samples[self.count - count:self.count]
+            self.samples = samples
+            self.count = count
+
+    def reset(self):
+        """Forget the partial measurement."""
+        self.state = IDLE
+        self.count = 0
+        self.size_mm = None
+
+    def resync(self, lost):
+        """Events were lost: the next edge can not be paired with the previous one."""
+        self.lost += lost
+        self.state = IDLE
+        self.count = 0
+
+    @property
+    def stats(self):
+        """ Counters as a dict """
+        return {'echoes': self.echoes, 'timeouts': self.timeouts,
+                'no_rising': self.no_rising, 'dup_rising': self.dup_rising,
+                'outliers': self.outliers, 'converged': self.converged, 'exhausted': self.exhausted,
+                'lost': self.lost}
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+""" Metrics in Prometheus text format over a local HTTP endpoint """
+
+import bisect
+import http.server
+import logging
+import threading
+
+# seconds
+LATENCY_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0)
+WRITE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Histogram:
+    """ Cumulative histogram, observe() is a bisect and two additions """
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count', 'scale')
+
+    def __init__(self, name, help_text, buckets, scale=1.0):
+        """
+        :param buckets: Upper bounds, in seconds.
+        :param scale: Observed values are in seconds * scale, e.g. 1e9 for perf_counter_ns() deltas.
+        """
+        self.name = name
+        self.help = help_text
+        self.scale = scale
+        self.bounds = [bound * scale for bound in buckets]
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound / self.scale:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum / self.scale}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """
+        Initialize the Registry.
+
+        Counters and gauges are not updated on the hot path: collectors read the existing
+        stats of the pipeline objects at scrape time.
+        """
+        self.histograms = []
+        self.collectors = []
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, scale=1.0):
+        histogram = Histogram(name, help_text, buckets, scale)
+        self.histograms.append(histogram)
+        return histogram
+
+    def collector(self, func):
+        """
+        Add a collector.
+
+        :param func: Returns an iterable of (name, type, help, [(labels dict, value), ...]).
+        """
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        """ All metrics in Prometheus text format """
+        lines = []
+        for collector in self.collectors:
+            try:
+                metrics = list(collector())
+            except Exception as exc:  # a broken collector must not break the scrape
+                logging.warning('collector %s failed: %s', collector.__name__, exc)
+                continue
+            for name, metric_type, help_text, samples in metrics:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f'{name}{_labels(labels)} {value}')
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, registry, host='127.0.0.1', port=9711):
+        """
+        Serve GET /metrics in a daemon thread.
+
+        :param registry: Registry to render.
+        """
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, fmt, *args):
+                logging.debug('metrics: ' + fmt, *args)
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='r3d-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('metrics on http://%s:%d/metrics', host, port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
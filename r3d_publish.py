@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+""" Publication of completed records to local subscribers over a Unix domain (or TCP) socket
+
+One JSON object per line, sent the moment a record is final:
+
+    {"seq": 17, "ts": 1714557600.123, "box_id": "A-...", "length": 30.1, "width": 20.0,
+     "height": 10.2, "weight": 1.25, "station": "A", "profile": null}
+
+seq counts the records of this process, a subscriber too slow to take them sees a gap.
+Try it with: socat - UNIX-CONNECT:/run/ruler3d/records.sock
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+
+import r3d_writer
+
+
+class Fanout:
+    def __init__(self, consumers):
+        """
+        Hand every record to several consumers, the first ones first.
+
+        :param consumers: Objects with put(record) -> bool, R3DPublisher, R3DWriter.
+        """
+        self.consumers = list(consumers)
+
+    def put(self, record):
+        """
+        :return: False if a consumer dropped the record.
+        """
+        taken = True
+        for consumer in self.consumers:
+            taken = consumer.put(record) and taken
+        return taken
+
+
+class Subscriber:
+    __slots__ = ('sock', 'fd', 'name', 'pending', 'dropped')
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.name = name
+        self.pending = bytearray()  # unsent tail, the socket buffer is full
+        self.dropped = 0
+
+
+class R3DPublisher:
+    def __init__(self, address, max_buffer=65536):
+        """
+        Initialize the R3DPublisher, nothing is bound before start().
+
+        put() and the socket callbacks run in the event loop thread, a send never blocks:
+        what the socket does not take waits in a per subscriber buffer, records that do not
+        fit in it are dropped for that subscriber only.
+
+        :param address: Unix socket path, or host:port for TCP.
+        :param max_buffer: Max unsent bytes per subscriber.
+        """
+        self.address = address
+        self.max_buffer = max_buffer
+        self.listener = None
+        self.loop = None
+        self.subscribers = {}
+        self.seq = 0
+        self.stats = {
+            'published': 0,
+            'dropped': 0,
+            'connected': 0,
+        }
+
+    @property
+    def is_unix(self):
+        return ':' not in self.address or self.address.startswith('/')
+
+    def start(self, loop):
+        """ Bind, listen and accept subscribers in the loop """
+        if self.is_unix:
+            if os.path.exists(self.address):
+                os.unlink(self.address)  # stale socket of a previous run
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(self.address)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, int(port)))
+        listener.listen(16)
+        listener.setblocking(False)
+        self.listener = listener
+        self.loop = loop
+        loop.add_reader(listener.fileno(), self._accept)
+        logging.info('publishing records on %s', self.address)
+
+    def _accept(self):
+        try:
+            sock, peer = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock, str(peer) if peer else 'unix')
+        self.subscribers[subscriber.fd] = subscriber
+        self.stats['connected'] += 1
+        # subscribers do not send, reading only notices the hang-up
+        self.loop.add_reader(subscriber.fd, self._on_readable, subscriber)
+        logging.info('subscriber %s connected, %d subscribers', subscriber.name, len(self.subscribers))
+
+    def _on_readable(self, subscriber):
+        try:
+            if subscriber.sock.recv(4096):
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        """ Forget a subscriber that hung up or failed """
+        self.loop.remove_reader(subscriber.fd)
+        if subscriber.pending:
+            self.loop.remove_writer(subscriber.fd)
+        del self.subscribers[subscriber.fd]
+        subscriber.sock.close()
+        logging.info('subscriber %s gone, %d records dropped for it', subscriber.name, subscriber.dropped)
+
+    def _send(self, subscriber, data):
+        """ Send what the socket takes now, return the rest, None if the subscriber failed """
+        try:
+            sent = subscriber.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(subscriber)
+            return None
+        return data[sent:]
+
+    def _on_writable(self, subscriber):
+        rest = self._send(subscriber, subscriber.pending)
+        if rest is None:
+            return
+        subscriber.pending = bytearray(rest)
+        if not rest:
+            self.loop.remove_writer(subscriber.fd)
+
+    def put(self, record):
+        """
+        Publish a record to all subscribers, never blocks.
+
+        :param record: A tuple of values in r3d_writer.R3D_COLUMNS order.
+        :return: True, a drop only concerns single subscribers.
+        """
+        if not self.subscribers:
+            return True
+        self.seq += 1
+        message = {'seq': self.seq, 'ts': round(time.time(), 3)}
+        message.update(zip(r3d_writer.R3D_COLUMNS, record))
+        if message['profile'] is not None:
+            # JSON text for PG and the journal, an object for the subscribers
+            message['profile'] = json.loads(message['profile'])
+        data = json.dumps(message, separators=(',', ':'), default=float).encode() + b'\n'
+        self.stats['published'] += 1
+        for subscriber in list(self.subscribers.values()):
+            if subscriber.pending:
+                if len(subscriber.pending) + len(data) > self.max_buffer:
+                    subscriber.dropped += 1
+                    self.stats['dropped'] += 1
+                else:
+                    subscriber.pending += data
+                continue
+            rest = self._send(subscriber, data)
+            if rest:
+                subscriber.pending = bytearray(rest)
+                self.loop.add_writer(subscriber.fd, self._on_writable, subscriber)
+        return True
+
+    def close(self):
+        """ Disconnect the subscribers and stop listening """
+        for subscriber in list(self.subscribers.values()):
+            self._drop(subscriber)
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+            self.listener = None
+            if self.is_unix and os.path.exists(self.address):
+                os.unlink(self.address)
+        logging.info('publisher stats: %s', self.stats)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Opt-in real-time mode of the edge listener: SCHED_FIFO/SCHED_RR, CPU affinity, mlockall, pre-warming """
+
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import resource
+
+POLICIES = {'fifo': os.SCHED_FIFO, 'rr': os.SCHED_RR}
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def parse_cpus(text):
+    """ CPU set of '2', '2,3' or '2-3', None for an empty string or -1 """
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part or part == '-1':
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus or None
+
+
+def options(config):
+    """ apply() arguments of the [realtime] section, None if not enabled """
+    if not config.getboolean('realtime', 'enabled', fallback=False):
+        return None
+    policy = config.get('realtime', 'policy', fallback='fifo').strip().lower()
+    if policy not in POLICIES:
+        raise ValueError(f"Invalid policy {policy}. Use 'fifo' or 'rr'.")
+    return {'policy': policy,
+            'priority': config.getint('realtime', 'priority', fallback=50),
+            'cpus': parse_cpus(config.get('realtime', 'cpus', fallback='')),
+            'mlock': config.getboolean('realtime', 'mlock', fallback=True)}
+
+
+def mlockall():
+    """
+    Lock the pages of the process in RAM, no page faults on the hot path.
+
+    Future mappings are locked too only if RLIMIT_MEMLOCK allows it: with a small limit
+    MCL_FUTURE would make later allocations fail instead.
+
+    :return: True if locked.
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    flags = MCL_CURRENT
+    if soft == resource.RLIM_INFINITY or os.geteuid() == 0:
+        flags |= MCL_FUTURE
+    else:
+        logging.warning('RLIMIT_MEMLOCK is %d bytes, only current pages are locked (LimitMEMLOCK=infinity)', soft)
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.mlockall(flags) != 0:
+        logging.warning('mlockall failed: %s', os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+
+def apply(policy='fifo', priority=50, cpus=None, mlock=True):
+    """
+    Real-time settings of the calling thread, call it in the listener thread after the helper threads
+    (writer, metrics, scale) are started: threads inherit the policy of the thread creating them.
+
+    A setting the process is not allowed to make (CAP_SYS_NICE, RLIMIT_RTPRIO, CAP_IPC_LOCK) is logged
+    and skipped, the listener runs on at normal priority.
+
+    :param policy: 'fifo' or 'rr'.
+    :param priority: Real-time priority, 1..99.
+    :param cpus: CPU set to pin the thread to or None.
+    :param mlock: Lock the process memory.
+    :return: True if all settings were applied.
+    """
+    applied = True
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as exc:
+            logging.warning('CPU affinity %s not set: %s', sorted(cpus), exc)
+            applied = False
+    try:
+        # processes started from here on (split mode) do not inherit it
+        os.sched_setscheduler(0, POLICIES[policy] | os.SCHED_RESET_ON_FORK, os.sched_param(priority))
+    except OSError as exc:
+        logging.warning('SCHED_%s priority %d not set: %s', policy.upper(), priority, exc)
+        applied = False
+    if mlock and not mlockall():
+        applied = False
+    if applied:
+        logging.info('real-time mode: SCHED_%s priority %d, cpus %s, mlock %s', policy.upper(), priority,
+                     sorted(cpus) if cpus else 'all', mlock)
+    return applied
+
+
+def prewarm(stations=()):
+    """
+    Warm up the hot path before the first edge.
+
+    Synthetic echoes run through throwaway line states of each station, then the startup objects are
+    moved out of the collector's way: a later collection does not traverse them.
+    """
+    for station in stations:
+        station.prewarm()
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+""" Binary recording and replay of raw GPIO edge events """
+
+import logging
+import mmap
+import struct
+import time
+
+import gpiod
+
+MAGIC = b'R3DEDGE1'
+# timestamp_ns, global_seqno, line_seqno, line_offset, event_type, chip index, padding to 32 bytes;
+# the chip index was padding before, recordings of a single chip read as chip 0
+RECORD = struct.Struct('<QQQIBB2x')
+# the same layout for numpy.frombuffer()
+RECORD_DTYPE = [('timestamp_ns', '<u8'), ('global_seqno', '<u8'), ('line_seqno', '<u8'),
+                ('line_offset', '<u4'), ('event_type', 'u1'), ('chip', 'u1'), ('pad', 'V2')]
+
+
+class EdgeRecorder:
+    def __init__(self, path, flush_every=4096):
+        """
+        Initialize the EdgeRecorder, append edge events to a file of fixed-size records.
+
+        :param path: Recording file name, appended to if it exists.
+        :param flush_every: Records buffered before a write.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.buffer = bytearray(RECORD.size * flush_every)
+        self.count = 0
+        self.total = 0
+
+    def record(self, event, chip=0):
+        """
+        Buffer one gpiod.EdgeEvent.
+
+        :param chip: Index of the chip of the event, in config order (Ruler3D.chips).
+        """
+        RECORD.pack_into(self.buffer, self.count * RECORD.size, event.timestamp_ns, event.global_seqno,
+                         event.line_seqno, event.line_offset, event.event_type.value, chip)
+        self.count += 1
+        if self.count == self.flush_every:
+            self.flush()
+
+    def for_chip(self, chip):
+        """ A recorder of the events of one chip into this file """
+        return ChipRecorder(self, chip)
+
+    def flush(self):
+        """Write the buffered records."""
+        if self.count:
+            self.file.write(memoryview(self.buffer)[:self.count * RECORD.size])
+            self.total += self.count
+            self.count = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        logging.info('%d edge events recorded to %s', self.total, self.path)
+
+
+class ChipRecorder:
+    __slots__ = ('recorder', 'chip')
+
+    def __init__(self, recorder, chip):
+        self.recorder = recorder
+        self.chip = chip
+
+    def record(self, event):
+        """Buffer one gpiod.EdgeEvent of the chip."""
+        self.recorder.record(event, self.chip)
+
+
+class EdgeFile:
+    def __init__(self, path):
+        """
+        Open a recording, memory-mapped.
+
+        :param path: Recording file name.
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not an edge recording')
+        # a partial trailing record (recorder killed mid-write) is ignored
+        self.count = (len(self.mmap) - len(MAGIC)) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Iterate over (timestamp_ns, global_seqno, line_seqno, line_offset, event_type, chip) tuples."""
+        end = len(MAGIC) + self.count * RECORD.size
+        return RECORD.iter_unpack(memoryview(self.mmap)[len(MAGIC):end])
+
+    def as_array(self):
+        """ The records as a numpy structured array, no copy """
+        import numpy
+
+        return numpy.frombuffer(self.mmap, dtype=numpy.dtype(RECORD_DTYPE), count=self.count, offset=len(MAGIC))
+
+    def close(self):
+        self.mmap.close()
+
+
+def replay(path, dispatchers, speed=0.0):
+    """
+    Feed a recording to the edge event dispatchers of its chips, an event at a time.
+
+    :param path: Recording file name.
+    :param dispatchers: Per chip index, called with a list of gpiod.EdgeEvent as read from the chip,
+                        ruler3d.ReplayEventHandler._dispatch.
+    :param speed: 1.0 is real time, 2.0 twice as fast, 0 as fast as possible.
+    :return: Number of events replayed.
+    """
+    edges = EdgeFile(path)
+    first_ns = None
+    started = time.monotonic_ns()
+    count = 0
+    try:
+        for timestamp_ns, global_seqno, line_seqno, line_offset, event_type, chip in edges:
+            if chip >= len(dispatchers):
+                raise ValueError(f'{path}: edges of chip {chip}, {len(dispatchers)} chips configured')
+            if speed:
+                if first_ns is None:
+                    first_ns = timestamp_ns
+                delay = (timestamp_ns - first_ns) / speed / 1e9 - (time.monotonic_ns() - started) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            dispatchers[chip]([gpiod.EdgeEvent(event_type=event_type, timestamp_ns=timestamp_ns,
+                                               line_offset=line_offset, global_seqno=global_seqno,
+                                               line_seqno=line_seqno)])
+            count += 1
+    finally:
+        edges.close()
+    elapsed = (time.monotonic_ns() - started) / 1e9
+    logging.info('%d edge events replayed from %s in %.3f sec', count, path, elapsed)
+    return count
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+""" Reports of shp.ruler3d from the hourly rollup, box lookup by id
+
+    r3d_report.py hourly --since '2024-05-01'       per hour and station
+    r3d_report.py daily --station A                 per day and station
+    r3d_report.py box 4711                          records of a box
+    r3d_report.py refresh                           bring the rollup up to date (cron)
+    r3d_report.py export /data/r3d --since '2024-01-01' --format parquet
+                                                    stream records to part files, resumable
+
+export writes one part file per chunk (CSV gzip, or Parquet zstd with pyarrow installed) and
+export.json with the last exported id: run the same command again to resume where it stopped,
+or later to add the records inserted since.
+"""
+
+import argparse
+import configparser
+import csv
+import gzip
+import json
+import os
+import sys
+
+import pg_app
+
+HOURLY = """SELECT hour, station, boxes, incomplete, no_weight,
+    length_avg, length_p50, length_p95, width_avg, width_p50, width_p95,
+    height_avg, height_p50, height_p95, weight_avg, weight_p50, weight_p95
+FROM shp.ruler3d_hourly
+WHERE hour >= %(since)s AND hour < %(until)s AND (%(station)s IS NULL OR station = %(station)s)
+ORDER BY hour, station;
+"""
+
+# averages weighted by the boxes each hourly average is over, percentiles do not add up and are left out
+DAILY = """SELECT hour::date AS day, station, sum(boxes) AS boxes,
+    round(100.0 * sum(incomplete) / nullif(sum(boxes), 0), 2) AS incomplete_pct,
+    round(100.0 * sum(no_weight) / nullif(sum(boxes), 0), 2) AS no_weight_pct,
+    round(sum(length_avg * length_boxes) / nullif(sum(length_boxes), 0), 2) AS length_avg,
+    round(sum(width_avg * width_boxes) / nullif(sum(width_boxes), 0), 2) AS width_avg,
+    round(sum(height_avg * height_boxes) / nullif(sum(height_boxes), 0), 2) AS height_avg,
+    round(sum(weight_avg * (boxes - no_weight)) / nullif(sum(boxes - no_weight), 0), 3) AS weight_avg
+FROM shp.ruler3d_hourly
+WHERE hour >= %(since)s AND hour < %(until)s AND (%(station)s IS NULL OR station = %(station)s)
+GROUP BY 1, 2
+ORDER BY 1, 2;
+"""
+
+BOX = """SELECT ins_ts, station, box_id, length, width, height, weight, profile
+FROM shp.ruler3d
+WHERE box_id = %(box_id)s
+ORDER BY ins_ts;
+"""
+
+REFRESH = "SELECT shp.ruler3d_rollup_refresh();"
+
+# in id order, the primary key index of every partition; the cast types map to plain python values
+EXPORT = """SELECT id, ins_ts, station, box_id, length::float8, width::float8, height::float8,
+    weight::float8, profile::text
+FROM shp.ruler3d
+WHERE id > %(after_id)s AND ins_ts >= %(since)s AND ins_ts < %(until)s
+    AND (%(station)s IS NULL OR station = %(station)s)
+ORDER BY id;
+"""
+EXPORT_COLUMNS = ('id', 'ins_ts', 'station', 'box_id', 'length', 'width', 'height', 'weight', 'profile')
+EXPORT_STATE = 'export.json'
+
+
+def query(pg, sql, params=None):
+    """ Run a query, return the column names and rows """
+    pg.curs.execute(sql, params)
+    return [col[0] for col in pg.curs.description], pg.curs.fetchall()
+
+
+def print_table(columns, rows, file=sys.stdout):
+    """ Tab separated, with a header """
+    print('\t'.join(columns), file=file)
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row), file=file)
+
+
+def write_csv(path, rows):
+    """ A part file as gzip compressed CSV with a header """
+    with gzip.open(path, 'wt', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_COLUMNS)
+        writer.writerows(rows)
+
+
+def write_parquet(path, rows):
+    """ A part file as zstd compressed Parquet """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([('id', pyarrow.int64()), ('ins_ts', pyarrow.timestamp('us')),
+                             ('station', pyarrow.string()), ('box_id', pyarrow.string()),
+                             ('length', pyarrow.float64()), ('width', pyarrow.float64()),
+                             ('height', pyarrow.float64()), ('weight', pyarrow.float64()),
+                             ('profile', pyarrow.string())])
+    columns = list(zip(*rows))
+    table = pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type)
+                                       for column, field in zip(columns, schema)], schema=schema)
+    pyarrow.parquet.write_table(table, path, compression='zstd')
+
+
+WRITERS = {'csv': ('csv.gz', write_csv), 'parquet': ('parquet', write_parquet)}
+
+
+def save_state(directory, state):
+    """ Replace the export state file atomically """
+    path = os.path.join(directory, EXPORT_STATE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def export(pg, directory, since='-infinity', until='infinity', station=None, file_format='csv', chunk_rows=100000,
+           after_id=0):
+    """
+    Stream records to part files in directory, one chunk of rows in memory at a time.
+
+    A server-side cursor sends chunk_rows rows per round trip. Each chunk becomes a part file,
+    written under a temporary name and renamed, then the last id is saved in export.json: an
+    interrupted export resumes after the last complete part.
+
+    :param since: ins_ts range start, a PG timestamp.
+    :param until: ins_ts range end.
+    :param station: One station only or None.
+    :param file_format: 'csv' or 'parquet'.
+    :param after_id: Start after this id, a fresh export only.
+    :raise ValueError: When directory holds an export of other parameters.
+    :return: Number of rows exported by this run.
+    """
+    extension, write = WRITERS[file_format]
+    params = {'since': since, 'until': until, 'station': station, 'format': file_format}
+    os.makedirs(directory, exist_ok=True)
+    try:
+        with open(os.path.join(directory, EXPORT_STATE)) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        state = dict(params, after_id=after_id, part=0, rows=0)
+    else:
+        if {key: state.get(key) for key in params} != params:
+            raise ValueError(f'{directory} holds an export of {state}, use another directory')
+
+    # named: rows stay on the server until fetched, the read transaction ends with the export
+    curs = pg.conn.cursor(name='ruler3d_export')
+    curs.itersize = chunk_rows
+    exported = 0
+    try:
+        curs.execute(EXPORT, dict(params, after_id=state['after_id']))
+        while True:
+            rows = curs.fetchmany(chunk_rows)
+            if not rows:
+                break
+            path = os.path.join(directory, f"part-{state['part']:05d}.{extension}")
+            write(path + '.tmp', rows)
+            os.replace(path + '.tmp', path)
+            state['after_id'] = rows[-1][0]
+            state['part'] += 1
+            state['rows'] += len(rows)
+            save_state(directory, state)
+            exported += len(rows)
+            print(f"{path}: {len(rows)} rows, last id {state['after_id']}", file=sys.stderr)
+    finally:
+        curs.close()
+        pg.conn.rollback()
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='\n'.join(__doc__.splitlines()[1:]))
+    parser.add_argument('--conf', default='ruler3d.conf', help='config with the [PG] section')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('hourly', 'daily'):
+        command = commands.add_parser(name, help=f'{name} boxes, error rates and sizes')
+        command.add_argument('--since', default="today", help="start, a PG timestamp, e.g. '2024-05-01 08:00'")
+        command.add_argument('--until', default='infinity', help='end, a PG timestamp')
+        command.add_argument('--station', help='one station only')
+    command = commands.add_parser('box', help='records of a box')
+    command.add_argument('box_id')
+    commands.add_parser('refresh', help='update the hourly rollup')
+    command = commands.add_parser('export', help='stream records to part files, resumable')
+    command.add_argument('directory', help='output directory, holds the part files and export.json')
+    command.add_argument('--since', default='-infinity', help='ins_ts start, a PG timestamp')
+    command.add_argument('--until', default='infinity', help='ins_ts end, a PG timestamp')
+    command.add_argument('--station', help='one station only')
+    command.add_argument('--format', choices=sorted(WRITERS), default='csv', help='part file format')
+    command.add_argument('--chunk-rows', type=int, default=100000, help='rows per part file')
+    command.add_argument('--after-id', type=int, default=0, help='start after this id (fresh export only)')
+    args = parser.parse_args()
+    if args.command == 'export' and args.format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            print('--format parquet needs pyarrow', file=sys.stderr)
+            return 1
+
+    config = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    config.read(args.conf)
+    pg = pg_app.PGapp(config['PG']['pg_host'], config['PG']['pg_user'])
+    if not pg.pg_connect():
+        print(f"no connection to {config['PG']['pg_host']}", file=sys.stderr)
+        return 1
+    if args.command == 'export':
+        # a server-side cursor lives in a transaction, no autocommit
+        try:
+            rows = export(pg, args.directory, since=args.since, until=args.until, station=args.station,
+                          file_format=args.format, chunk_rows=args.chunk_rows, after_id=args.after_id)
+        except ValueError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        print(f'{rows} rows exported', file=sys.stderr)
+        return 0
+    pg.set_session(autocommit=True)
+
+    if args.command == 'hourly':
+        print_table(*query(pg, HOURLY, vars(args)))
+    elif args.command == 'daily':
+        print_table(*query(pg, DAILY, vars(args)))
+    elif args.command == 'box':
+        print_table(*query(pg, BOX, vars(args)))
+    else:
+        columns, rows = query(pg, REFRESH)
+        print(f'{rows[0][0]} station hours rolled up', file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+""" Scale (weight) readers, sampled in their own thread and time-aligned to box sessions """
+
+import collections
+import logging
+import os
+import re
+import termios
+import threading
+import time
+
+
+class ScaleReader:
+    def __init__(self, history=1024):
+        """
+        Initialize the ScaleReader.
+
+        Samples are kept with time.monotonic_ns() timestamps, the clock of gpiod edge events,
+        so weight can be looked up for the time window of a box session.
+
+        :param history: Number of samples kept.
+        """
+        self.samples = collections.deque(maxlen=history)
+        self.running = True
+        self.stats = {'samples': 0, 'errors': 0}
+        self.thread = threading.Thread(target=self._reader, name=type(self).__name__)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start the reader thread."""
+        self.thread.start()
+        return self
+
+    def read(self):
+        """Return one weight sample in kg, block until it is available. None if there is nothing yet."""
+        raise NotImplementedError
+
+    def _reader(self):
+        """Sample the scale until stopped."""
+        while self.running:
+            try:
+                weight = self.read()
+            except (OSError, ValueError) as exc:
+                self.stats['errors'] += 1
+                logging.warning('%s: %s', type(self).__name__, exc)
+                time.sleep(1)
+                continue
+            if weight is not None:
+                # deque.append is atomic, no lock needed against weight_between()
+                self.samples.append((time.monotonic_ns(), weight))
+                self.stats['samples'] += 1
+
+    def weight_between(self, start_ns, end_ns):
+        """
+        Median weight sampled in the time window.
+
+        :return: Weight in kg or None if there are no samples in the window.
+        """
+        window = sorted(weight for ts, weight in list(self.samples) if start_ns <= ts <= end_ns)
+        if not window:
+            return None
+        return window[len(window) // 2]
+
+    def stop(self):
+        """Stop the reader thread."""
+        self.running = False
+        self.thread.join(2)
+        logging.info('%s stats: %s', type(self).__name__, self.stats)
+
+
+class HX711Scale(ScaleReader):
+    GAIN_PULSES = {128: 1, 32: 2, 64: 3}
+    # the HX711 powers down after PD_SCK is high for 60 us
+    SCK_HIGH_MAX_NS = 50_000
+
+    def __init__(self, chip_name, dout_line, sck_line, gain=128, offset=0, scale=1.0, interval=0.1, **kwargs):
+        """
+        Initialize the HX711Scale.
+
+        :param chip_name: The GPIO chip name (e.g., 'gpiochip0').
+        :param dout_line: HX711 DOUT line.
+        :param sck_line: HX711 PD_SCK line.
+        :param gain: Channel A gain 128 or 64, channel B gain 32.
+        :param offset: Raw reading of the empty scale.
+        :param scale: Raw units per kg.
+        :param interval: Pause between samples, sec.
+
+        The bit-bang runs in a Python thread: a thread switch while PD_SCK is high (likely next to
+        the event loop in [realtime] mode) stretches the pulse. Each high phase is timed, a sample with
+        one longer than SCK_HIGH_MAX_NS is discarded, and so is the next one, the chip may have
+        powered down and come back at gain 128.
+        """
+        import gpiod
+        from gpiod.line import Direction, Value
+
+        super().__init__(**kwargs)
+        self.value_active = Value.ACTIVE
+        self.value_inactive = Value.INACTIVE
+        self.dout_line = dout_line
+        self.sck_line = sck_line
+        self.pulses = self.GAIN_PULSES[gain]
+        self.offset = offset
+        self.scale = scale
+        self.interval = interval
+        self.stats['discarded'] = 0
+        self.high_ns = 0  # longest PD_SCK high phase of the current sample
+        self.skip = 0  # samples to discard after an overlong pulse
+        self.request = gpiod.request_lines(chip_name, consumer="ruler3d-hx711",
+                                           config={
+                                               dout_line: gpiod.LineSettings(direction=Direction.INPUT),
+                                               sck_line: gpiod.LineSettings(direction=Direction.OUTPUT,
+                                                                            output_value=Value.INACTIVE),
+                                           }
+                                           )
+
+    def _clock(self):
+        """One PD_SCK pulse, return DOUT sampled while SCK is high."""
+        self.request.set_value(self.sck_line, self.value_active)
+        high_ns = time.perf_counter_ns()
+        bit = self.request.get_value(self.dout_line) == self.value_active
+        self.request.set_value(self.sck_line, self.value_inactive)
+        high_ns = time.perf_counter_ns() - high_ns
+        if high_ns > self.high_ns:
+            self.high_ns = high_ns
+        return bit
+
+    def read(self):
+        time.sleep(self.interval)
+        # DOUT goes low when a conversion is ready
+        deadline = time.monotonic() + 1.0
+        while self.request.get_value(self.dout_line) == self.value_active:
+            if time.monotonic() > deadline:
+                raise OSError('HX711 not ready')
+            time.sleep(0.001)
+        raw = 0
+        self.high_ns = 0
+        for _ in range(24):
+            raw = (raw << 1) | self._clock()
+        for _ in range(self.pulses):
+            self._clock()
+        if self.high_ns > self.SCK_HIGH_MAX_NS:
+            self.skip = 2
+            logging.debug('HX711 PD_SCK high for %d us, sample discarded', self.high_ns // 1000)
+        if self.skip:
+            self.skip -= 1
+            self.stats['discarded'] += 1
+            return None
+        if raw & 0x800000:
+            raw -= 0x1000000
+        return (raw - self.offset) / self.scale
+
+    def stop(self):
+        super().stop()
+        self.request.release()
+
+
+class SerialScale(ScaleReader):
+    BAUDRATES = {1200: termios.B1200, 2400: termios.B2400, 4800: termios.B4800, 9600: termios.B9600,
+                 19200: termios.B19200, 38400: termios.B38400, 57600: termios.B57600, 115200: termios.B115200}
+    # "ST,GS,+  1.234kg" and alike: a signed decimal, optionally followed by a unit
+    WEIGHT_RE = re.compile(rb'([-+]?)\s*(\d+(?:\.\d+)?)\s*(kg|g)?', re.IGNORECASE)
+
+    def __init__(self, device, baudrate=9600, stable_only=True, **kwargs):
+        """
+        Initialize the SerialScale, a load-cell indicator sending one line per sample.
+
+        :param device: Serial device, e.g. /dev/ttyUSB0.
+        :param baudrate: Baud rate.
+        :param stable_only: Skip lines flagged unstable ('US').
+        """
+        super().__init__(**kwargs)
+        self.device = device
+        self.stable_only = stable_only
+        self.fd = os.open(device, os.O_RDONLY | os.O_NOCTTY)
+        attrs = termios.tcgetattr(self.fd)
+        attrs[0] = 0  # iflag
+        attrs[1] = 0  # oflag
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL  # cflag
+        attrs[3] = 0  # lflag: raw
+        attrs[4] = attrs[5] = self.BAUDRATES[baudrate]
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 5  # read() returns after 0.5 sec without data
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        self.buffer = b''
+
+    def read(self):
+        while b'\n' not in self.buffer:
+            chunk = os.read(self.fd, 256)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        if self.stable_only and line.startswith(b'US'):
+            return None
+        return self.parse(line)
+
+    @classmethod
+    def parse(cls, line):
+        """ Weight in kg from an indicator line """
+        match = cls.WEIGHT_RE.search(line.split(b',')[-1])
+        if match is None:
+            raise ValueError(f'no weight in {line!r}')
+        weight = float(match.group(2))
+        if match.group(1) == b'-':
+            weight = -weight
+        if match.group(3) and match.group(3).lower() == b'g':
+            weight /= 1000
+        return weight
+
+    def stop(self):
+        super().stop()
+        os.close(self.fd)
+
+
+class FakeSerialScale(SerialScale):
+    def __init__(self, weight=1.0, rate=10, **kwargs):
+        """
+        SerialScale reading a pty fed by an indicator stand-in, for tests without hardware.
+
+        :param weight: Weight sent by the stand-in, kg.
+        :param rate: Lines per second.
+        """
+        self.weight = weight
+        self.rate = rate
+        self.master_fd, slave_fd = os.openpty()
+        device = os.ttyname(slave_fd)
+        super().__init__(device, **kwargs)
+        os.close(slave_fd)
+        self.feeder = threading.Thread(target=self._feed, name='fake-scale')
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self):
+        while self.running:
+            os.write(self.master_fd, f'ST,GS,+{self.weight:8.3f}kg\r\n'.encode())
+            time.sleep(1 / self.rate)
+
+    def stop(self):
+        super().stop()
+        os.close(self.master_fd)
+
+
+def make_scale(config, chip_name, section='scale'):
+    """
+    Build the scale reader from a config section, [scale] by default.
+
+    :return: A started ScaleReader or None if type is none / missing.
+    """
+    scale_type = config.get(section, 'type', fallback='none')
+    history = config.getint(section, 'history', fallback=1024)
+    if scale_type == 'none':
+        return None
+    if scale_type == 'hx711':
+        scale = HX711Scale(config.get(section, 'chip_name', fallback=chip_name),
+                           config.getint(section, 'dout_line'), config.getint(section, 'sck_line'),
+                           gain=config.getint(section, 'gain', fallback=128),
+                           offset=config.getfloat(section, 'offset', fallback=0),
+                           scale=config.getfloat(section, 'scale', fallback=1.0),
+                           interval=config.getfloat(section, 'interval', fallback=0.1),
+                           history=history)
+    elif scale_type == 'serial':
+        scale = SerialScale(config.get(section, 'device'),
+                            baudrate=config.getint(section, 'baudrate', fallback=9600),
+                            history=history)
+    elif scale_type == 'fake':
+        scale = FakeSerialScale(weight=config.getfloat(section, 'fake_weight', fallback=1.0), history=history)
+    else:
+        raise ValueError(f"Invalid scale type {scale_type}. Use 'none', 'hx711', 'serial' or 'fake'.")
+    return scale.start()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+""" Box ids and box sessions for the conveyor streaming mode """
+
+import collections
+import logging
+import time
+
+
+class BoxIds:
+    def __init__(self, prefix=''):
+        """
+        Initialize the BoxIds.
+
+        Ids supplied from outside (barcode scanner, upstream system) are used first, in order,
+        otherwise an id is generated: prefix + start time + counter, unique across restarts.
+
+        :param prefix: Generated id prefix, e.g. a station name.
+        """
+        self.prefix = prefix
+        self.started = time.strftime('%Y%m%d%H%M%S')
+        self.counter = 0
+        self.supplied = collections.deque()
+
+    def supply(self, box_id):
+        """Queue an external box id for the next box."""
+        self.supplied.append(str(box_id))
+
+    def next(self):
+        """Return the id for a new box."""
+        if self.supplied:
+            return self.supplied.popleft()
+        self.counter += 1
+        return f'{self.prefix}{self.started}-{self.counter}'
+
+
+class BoxSession:
+    """ Readings of one box between its arrival and departure """
+    __slots__ = ('box_id', 'opened_ns', 'closed_ns', 'readings')
+
+    def __init__(self, opened_ns, names):
+        self.box_id = None
+        self.opened_ns = opened_ns
+        self.closed_ns = None
+        self.readings = {name: [] for name in names}
+
+    def size(self):
+        """ Median size per axis in cm, None for an axis never occupied """
+        size = {}
+        for name, readings in self.readings.items():
+            if readings:
+                readings.sort()
+                size[name] = readings[len(readings) // 2] / 10
+            else:
+                size[name] = None
+        return size
+
+
+class BoxSegmenter:
+    def __init__(self, names, box_ids, presence_cm=2.0, depart_readings=3, min_readings=1):
+        """
+        Initialize the BoxSegmenter.
+
+        An axis is occupied while its size differs from the empty table (size 0) by more than
+        presence_cm. A box arrives with the first occupied reading and departs after
+        depart_readings readings in a row with all axes clear.
+
+        :param names: Axis names.
+        :param box_ids: BoxIds instance.
+        :param presence_cm: Min size which means something is on the table.
+        :param depart_readings: Clear readings in a row which close a session.
+        :param min_readings: Sessions with fewer occupied readings are discarded as noise.
+        """
+        self.names = tuple(names)
+        self.box_ids = box_ids
+        self.configure(presence_cm, depart_readings, min_readings)
+        self.occupied = dict.fromkeys(self.names, False)
+        self.session = None
+        self.clear = 0
+        self.stats = {'boxes': 0, 'discarded': 0}
+
+    def configure(self, presence_cm=2.0, depart_readings=3, min_readings=1):
+        """Set the thresholds, an open session is kept."""
+        self.presence_mm = int(round(presence_cm * 10))
+        self.depart_readings = depart_readings
+        self.min_readings = min_readings
+
+    def update(self, name, size_mm, timestamp_ns):
+        """
+        Feed a size of an axis.
+
+        :return: The closed BoxSession when the box has departed, else None.
+        """
+        occupied = size_mm > self.presence_mm
+        self.occupied[name] = occupied
+        if occupied:
+            self.clear = 0
+            if self.session is None:
+                self.session = BoxSession(timestamp_ns, self.names)
+                logging.debug('box arrived')
+            self.session.readings[name].append(size_mm)
+            return None
+
+        if self.session is None or any(self.occupied.values()):
+            return None
+        self.clear += 1
+        if self.clear < self.depart_readings:
+            return None
+
+        session = self.session
+        self.session = None
+        self.clear = 0
+        session.closed_ns = timestamp_ns
+        if sum(len(readings) for readings in session.readings.values()) < self.min_readings:
+            self.stats['discarded'] += 1
+            logging.debug('box discarded as noise')
+            return None
+        # the id is taken only now so that noise does not use up a supplied one
+        session.box_id = self.box_ids.next()
+        self.stats['boxes'] += 1
+        logging.debug('box %s departed', session.box_id)
+        return session
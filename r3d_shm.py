@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+""" Split mode: edge acquisition in its own process, edges passed over a shared-memory ring buffer """
+
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import select
+import struct
+from multiprocessing import shared_memory
+
+import gpiod
+
+# timestamp_ns, global_seqno, line_seqno, line_offset, event_type, chip index, padding to 32 bytes
+RECORD = struct.Struct('<QQQIBB2x')
+# the same layout for numpy.frombuffer()
+RECORD_DTYPE = [('timestamp_ns', '<u8'), ('global_seqno', '<u8'), ('line_seqno', '<u8'),
+                ('line_offset', '<u4'), ('event_type', 'u1'), ('chip', 'u1'), ('pad', 'V2')]
+# the head announced over the wake-up pipe
+HEAD_MSG = struct.Struct('<Q')
+# head (written by the producer) and tail (written by the consumer) on separate cache lines
+HEAD = 0
+DROPPED = 8
+TAIL = 64
+DATA = 128
+
+
+class EdgeRing:
+    def __init__(self, name=None, capacity=65536):
+        """
+        Single producer, single consumer ring of fixed-size edge records in shared memory.
+
+        head and tail are free-running 64-bit counters, each written by one side only.
+        Plain stores to shared memory are not ordered on a weakly ordered CPU (ARM): the consumer
+        may see the head store before the record bytes. So the consumer does not read head from
+        the ring, the producer announces it over the wake-up pipe after the records are written;
+        the pipe write and read order the stores before the loads, the consumer pops up to the
+        last head read from the pipe.
+
+        :param name: Name of an existing ring to attach to, None creates a new one.
+        :param capacity: Number of records, a power of two.
+        """
+        if capacity & (capacity - 1):
+            raise ValueError('capacity must be a power of two')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=DATA + capacity * RECORD.size)
+            self.shm.buf[:DATA] = bytes(DATA)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.counters = self.buf[:DATA].cast('Q')
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def head(self):
+        """ Producer: records pushed so far """
+        return self.counters[HEAD // 8]
+
+    @property
+    def dropped(self):
+        """ Records dropped by the producer, ring full """
+        return self.counters[DROPPED // 8]
+
+    def push(self, records):
+        """
+        Producer: append records, drop what does not fit.
+
+        :param records: Iterable of tuples in RECORD order.
+        :return: Number of records pushed.
+        """
+        counters = self.counters
+        head = counters[HEAD // 8]
+        free = self.capacity - (head - counters[TAIL // 8])
+        pushed = 0
+        for record in records:
+            if pushed == free:
+                counters[DROPPED // 8] += 1
+                continue
+            RECORD.pack_into(self.buf, DATA + ((head + pushed) & self.mask) * RECORD.size, *record)
+            pushed += 1
+        counters[HEAD // 8] = head + pushed
+        return pushed
+
+    def pop(self, head, max_records=4096):
+        """
+        Consumer: take the available records.
+
+        :param head: Head announced by the producer over the wake-up pipe.
+        :return: A list of tuples in RECORD order.
+        """
+        counters = self.counters
+        tail = counters[TAIL // 8]
+        count = min(head - tail, max_records)
+        records = [RECORD.unpack_from(self.buf, DATA + ((tail + num) & self.mask) * RECORD.size)
+                   for num in range(count)]
+        counters[TAIL // 8] = tail + count
+        return records
+
+    def pop_array(self, head, max_records=65536):
+        """
+        Consumer: take the available records as a numpy array, no per record work.
+
+        :param head: Head announced by the producer over the wake-up pipe.
+        :return: numpy array of RECORD_DTYPE, a copy.
+        """
+        import numpy
+
+        counters = self.counters
+        tail = counters[TAIL // 8]
+        count = min(head - tail, max_records)
+        dtype = numpy.dtype(RECORD_DTYPE)
+        first = tail & self.mask
+        head_part = min(count, self.capacity - first)
+        records = numpy.frombuffer(self.buf, dtype=dtype, count=head_part, offset=DATA + first * RECORD.size)
+        if count > head_part:
+            # wrapped around the end of the ring
+            records = numpy.concatenate((records, numpy.frombuffer(self.buf, dtype=dtype, count=count - head_part,
+                                                                   offset=DATA)))
+        else:
+            records = records.copy()
+        counters[TAIL // 8] = tail + count
+        return records
+
+    def close(self):
+        self.counters.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def acquire(ring_name, capacity, notify, chips, event_buffer_size, max_events, cpu, stop, bias=None, realtime=None):
+    """
+    Acquisition process: read edge events of all chips and push them to the ring, nothing else.
+
+    :param ring_name: EdgeRing name.
+    :param capacity: EdgeRing capacity.
+    :param notify: Write end (multiprocessing Connection) of the pipe waking up the consumer, it carries the head.
+    :param chips: A list of (chip name, line offsets, {line offset: debounce period, us}),
+                  the ring carries the index into it.
+    :param event_buffer_size: Kernel event FIFO size or None.
+    :param max_events: Max events per read or None.
+    :param cpu: CPU to pin the process to or None.
+    :param stop: multiprocessing.Event set to stop.
+    :param bias: gpiod.line.Bias of the lines, None leaves it as is.
+    :param realtime: r3d_realtime.apply() arguments or None, the CPU is the cpu argument.
+    """
+    from gpiod.line import Edge
+
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    if realtime is not None:
+        import r3d_realtime
+
+        r3d_realtime.apply(**dict(realtime, cpus=None))
+    ring = EdgeRing(ring_name, capacity)
+    notify_fd = notify.fileno()
+    os.set_blocking(notify_fd, False)
+    requests = {}
+    poller = select.poll()
+    try:
+        for chip_idx, (chip_name, lines, debounce) in enumerate(chips):
+            groups = {}
+            for line in lines:
+                groups.setdefault(debounce.get(line, 0), []).append(line)
+            config = {}
+            for debounce_us, group in groups.items():
+                settings = {'edge_detection': Edge.BOTH}
+                if bias is not None:
+                    settings['bias'] = bias
+                if debounce_us:
+                    settings['debounce_period'] = datetime.timedelta(microseconds=debounce_us)
+                config[tuple(group)] = gpiod.LineSettings(**settings)
+            request = gpiod.request_lines(chip_name, consumer="ruler3d-acquire", config=config,
+                                          event_buffer_size=event_buffer_size)
+            requests[request.fd] = (chip_idx, request)
+            poller.register(request.fd, select.POLLIN)
+        announced = 0
+        while not stop.is_set():
+            for fd, _ in poller.poll(200):
+                chip_idx, request = requests[fd]
+                ring.push((event.timestamp_ns, event.global_seqno, event.line_seqno, event.line_offset,
+                           event.event_type.value, chip_idx) for event in request.read_edge_events(max_events))
+            head = ring.head
+            if head != announced:
+                try:
+                    # 8 bytes, below PIPE_BUF: written whole or not at all
+                    os.write(notify_fd, HEAD_MSG.pack(head))
+                    announced = head
+                except BlockingIOError:
+                    pass  # the consumer has not drained the pipe yet, announced again next round
+    finally:
+        for _, request in requests.values():
+            request.release()
+        ring.close()
+
+
+class SplitAcquisition:
+    def __init__(self, handlers, capacity=65536, event_buffer_size=None, max_events=None, cpu=None, bias=None,
+                 realtime=None):
+        """
+        Start the acquisition process.
+
+        :param handlers: Per chip consumers with chip_name, line_numbers, debounce and _dispatch(events),
+                         ruler3d.ShmEventHandler.
+        :param capacity: Ring capacity, records.
+        :param event_buffer_size: Kernel event FIFO size or None.
+        :param max_events: Max events per read or None.
+        :param cpu: CPU to pin the acquisition process to or None.
+        :param bias: gpiod.line.Bias of the lines, None leaves it as is.
+        :param realtime: r3d_realtime.apply() arguments of the acquisition process or None.
+        """
+        self.handlers = list(handlers)
+        self.ring = EdgeRing(capacity=capacity)
+        ctx = multiprocessing.get_context('spawn')
+        self.notify, notify_w = ctx.Pipe(duplex=False)
+        self.notify_fd = self.notify.fileno()
+        os.set_blocking(self.notify_fd, False)
+        self.stop_event = ctx.Event()
+        self.head = 0  # the last head announced by the producer
+        chips = [(handler.chip_name, tuple(handler.line_numbers), handler.debounce) for handler in self.handlers]
+        self.process = ctx.Process(target=acquire, name='r3d-acquire', daemon=True,
+                                   args=(self.ring.name, capacity, notify_w, chips, event_buffer_size,
+                                         max_events, cpu, self.stop_event, bias, realtime))
+        self.process.start()
+        notify_w.close()
+        self.loop = None
+
+    def start(self, loop=None):
+        """Register the wake-up pipe with the event loop."""
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.loop.add_reader(self.notify_fd, self._on_readable)
+        self.loop.add_reader(self.process.sentinel, self._on_exit)
+
+    def _on_exit(self):
+        """The acquisition process ended before aclose(), no more events will come."""
+        self.loop.remove_reader(self.process.sentinel)
+        self.process.join()
+        logging.error('acquisition process exited with code %s', self.process.exitcode)
+
+    def _on_readable(self):
+        """Drain the wake-up pipe and the ring up to the last announced head, dispatch events per chip."""
+        try:
+            while True:
+                # whole messages only: every write is 8 bytes and 4096 is a multiple of 8
+                data = os.read(self.notify_fd, 4096)
+                if not data:
+                    break
+                self.head, = HEAD_MSG.unpack_from(data, len(data) - HEAD_MSG.size)
+        except BlockingIOError:
+            pass
+        head = self.head
+        if self.handlers[0].batch_callback is not None:
+            records = self.ring.pop_array(head)
+            while len(records):
+                if len(self.handlers) == 1:
+                    self.handlers[0]._dispatch_array(records)
+                else:
+                    for chip_idx, handler in enumerate(self.handlers):
+                        chip_records = records[records['chip'] == chip_idx]
+                        if len(chip_records):
+                            handler._dispatch_array(chip_records)
+                records = self.ring.pop_array(head)
+            return
+        records = self.ring.pop(head)
+        while records:
+            batches = [[] for _ in self.handlers]
+            for timestamp_ns, global_seqno, line_seqno, line_offset, event_type, chip_idx in records:
+                batches[chip_idx].append(gpiod.EdgeEvent(event_type=event_type, timestamp_ns=timestamp_ns,
+                                                         line_offset=line_offset, global_seqno=global_seqno,
+                                                         line_seqno=line_seqno))
+            for handler, events in zip(self.handlers, batches):
+                if events:
+                    handler._dispatch(events)
+            records = self.ring.pop(head)
+
+    async def aclose(self, timeout=1.0):
+        """Stop the acquisition process and free the ring."""
+        if self.loop is not None:
+            self.loop.remove_reader(self.notify_fd)
+            self.loop.remove_reader(self.process.sentinel)
+        self.stop_event.set()
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        if self.ring.dropped:
+            logging.warning('%d edge events dropped, ring full', self.ring.dropped)
+        self.notify.close()
+        self.ring.close()
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+""" A scanner station: length/width/height sensors, their measurement state and box records """
+
+import json
+import logging
+import math
+import re
+
+import r3d_measure
+import r3d_scale
+import r3d_session
+import r3d_trigger
+
+AXES = ('length', 'width', 'height')
+# gpiod.EdgeEvent.Type.RISING_EDGE, the event_type of batch arrays
+RISING = 1
+
+# how the sensors of an axis make one size
+FUSE = {'max': max, 'min': min, 'mean': lambda sizes: sum(sizes) / len(sizes)}
+
+ESTIMATOR_OPTIONS = (('samples', int), ('min_samples', int), ('tolerance_cm', float), ('outlier_cm', float),
+                     ('estimator', str), ('trim', float), ('ns_per_cm', int))
+
+
+class Station:
+    def __init__(self, config, name, chip_name, writer, prefix='', box_id_prefix=''):
+        """
+        Initialize the Station.
+
+        :param config: ConfigParser of ruler3d.conf.
+        :param name: Station name, stored with every record.
+        :param chip_name: The GPIO chip of the station lines.
+        :param writer: Record consumer shared by all stations, R3DWriter or r3d_publish.Fanout.
+        :param prefix: Config section prefix, axis sections are prefix + 'length' etc.,
+                       the scale section is prefix + 'scale'.
+        :param box_id_prefix: Prefix of generated box ids.
+        """
+        self.config = config
+        self.name = name
+        self.chip_name = chip_name
+        self.writer = writer
+        self.prefix = prefix
+        self.trigger = None
+        # (min, max) echo pulse width, ns, of the batch path; the per event path filters in the handler
+        self.pulse_filter = None
+
+        self.line_def = self.make_line_def(config)
+        self.line_state = self.make_line_state(config, self.line_def)
+        self.states = tuple(self.line_state.values())
+        self.axis_sensors = self.make_axis_sensors(self.line_def)
+        self.filtered = dict.fromkeys(self.line_state, 0)
+        # echo lines as a list for numpy.isin() of the batch path
+        self.line_array = list(self.line_state)
+
+        scale_section = prefix + 'scale'
+        self.scale = r3d_scale.make_scale(config, chip_name, section=scale_section)
+        self.scale_window_ns = int(config.getfloat(scale_section, 'window_ms', fallback=500) * 1_000_000)
+
+        self.box_ids = r3d_session.BoxIds(prefix=box_id_prefix)
+        self.segmenter = None
+        if config.getboolean('stream', 'enabled', fallback=False):
+            self.segmenter = r3d_session.BoxSegmenter(
+                [line['sensor'] for line in self.line_def.values()], self.box_ids, **self.segmenter_options(config))
+        # the scan idles while the table stays as it is and bursts on a change
+        self.scan_rate = None
+        if config.getfloat('trigger', 'idle_rate', fallback=0):
+            self.scan_rate = r3d_trigger.ScanRate([line['sensor'] for line in self.line_def.values()],
+                                                  **self.scan_rate_options(config))
+
+    def sensor_sections(self, config, axis):
+        """ Sections of the sensors of an axis: the axis section, then [axis.2], [axis.3] ... in number order """
+        pattern = re.compile(re.escape(self.prefix + axis) + r'\.(\d+)$')
+        numbered = sorted((int(match.group(1)), section) for section in config.sections()
+                          for match in (pattern.match(section),) if match)
+        return [self.prefix + axis] + [section for _, section in numbered]
+
+    def make_line_def(self, config):
+        """
+        {echo line offset: {'axis', 'sensor', 'base', 'name', 'debounce_us', 'x', 'y', 'group'[, 'trg_line']}}
+        of the sensor sections, in AXES order.
+
+        sensor is the section name without the station prefix, e.g. 'height' or 'height.2';
+        x, y (position, cm) and group (trigger group) are None if not set.
+        """
+        line_def = {}
+        for axis in AXES:
+            fuse = config.get(self.prefix + axis, 'fuse', fallback='max')
+            if fuse not in FUSE:
+                raise ValueError(f"Invalid fuse {fuse} in [{self.prefix + axis}]. Use 'max', 'min' or 'mean'.")
+            for section in self.sensor_sections(config, axis):
+                sensor = section[len(self.prefix):]
+                line = {'axis': axis, 'sensor': sensor, 'base': config.getfloat(section, 'base'),
+                        'name': config.get(section, 'name', fallback=sensor),
+                        'debounce_us': config.getint(section, 'debounce_us',
+                                                     fallback=config.getint('GPIO', 'debounce_us', fallback=0)),
+                        'x': config.getfloat(section, 'x', fallback=None),
+                        'y': config.getfloat(section, 'y', fallback=None),
+                        'group': config.getint(section, 'group', fallback=None)}
+                if config.has_option(section, 'trg_line'):
+                    line['trg_line'] = config.getint(section, 'trg_line')
+                line_offset = config.getint(section, 'line')
+                if line_offset in line_def:
+                    raise ValueError(f'station {self.name}: line {line_offset} of [{section}] is used twice')
+                line_def[line_offset] = line
+        return line_def
+
+    @staticmethod
+    def make_axis_sensors(line_def):
+        """ {axis: [sensor, ...]} in line_def order """
+        axis_sensors = {axis: [] for axis in AXES}
+        for line in line_def.values():
+            axis_sensors[line['axis']].append(line['sensor'])
+        return axis_sensors
+
+    def make_line_state(self, config, line_def):
+        """ {echo line offset: LineState}, in AXES order """
+        line_state = {}
+        for line_offset, line in line_def.items():
+            section = self.prefix + line['sensor']
+            options = self.estimator_options(section, config)
+            if config.has_option(section, 'base_ns'):
+                options['base_ns'] = config.getint(section, 'base_ns')
+            line_state[line_offset] = r3d_measure.LineState(line_offset, line['name'], line['base'], **options)
+        return line_state
+
+    def estimator_options(self, section, config=None):
+        """ Estimator settings of an axis section, [estimator] values by default """
+        if config is None:
+            config = self.config
+        options = {}
+        for key, conv in ESTIMATOR_OPTIONS:
+            value = config.get(section, key, fallback=config.get('estimator', key, fallback=None))
+            if value is not None:
+                options[key] = conv(value)
+        return options
+
+    @staticmethod
+    def segmenter_options(config):
+        return {'presence_cm': config.getfloat('stream', 'presence_cm', fallback=2.0),
+                'depart_readings': config.getint('stream', 'depart_readings', fallback=3),
+                'min_readings': config.getint('stream', 'min_readings', fallback=1)}
+
+    @staticmethod
+    def trigger_options(config):
+        return {'pulse_us': config.getfloat('trigger', 'pulse_us', fallback=10),
+                'echo_timeout_ms': config.getfloat('trigger', 'echo_timeout_ms', fallback=38),
+                'settle_ms': config.getfloat('trigger', 'settle_ms', fallback=2),
+                'cycle_rate': config.getfloat('trigger', 'cycle_rate', fallback=0)}
+
+    @staticmethod
+    def scan_rate_options(config):
+        return {'idle_rate': config.getfloat('trigger', 'idle_rate', fallback=0),
+                'idle_cm': config.getfloat('trigger', 'idle_cm', fallback=2.0),
+                'skip_unchanged': config.getboolean('trigger', 'skip_unchanged', fallback=False)}
+
+    def prepare_reload(self, config):
+        """
+        Check a reloaded config and build the new settings, nothing is changed yet.
+
+        Lines, the chip, the scale, stream/trigger on/off and the idle rate on/off need a restart.
+
+        :raise ValueError: When the config can not be applied on the fly.
+        :return: A function applying the settings, called between two edge events.
+        """
+        line_def = self.make_line_def(config)
+        if [(offset, line.get('trg_line')) for offset, line in line_def.items()] != \
+                [(offset, line.get('trg_line')) for offset, line in self.line_def.items()]:
+            raise ValueError(f'station {self.name}: lines changed, restart needed')
+        for section, key in (('stream', 'enabled'), ('trigger', 'enabled')):
+            if config.getboolean(section, key, fallback=False) != self.config.getboolean(section, key,
+                                                                                         fallback=False):
+                raise ValueError(f'[{section}] {key} changed, restart needed')
+        if bool(config.getfloat('trigger', 'idle_rate', fallback=0)) != (self.scan_rate is not None):
+            raise ValueError('[trigger] idle_rate switched on or off, restart needed')
+        line_state = self.make_line_state(config, line_def)
+        segmenter_options = self.segmenter_options(config)
+        scan_rate_options = self.scan_rate_options(config)
+        trigger_options = self.trigger_options(config)
+
+        def apply():
+            self.config = config
+            self.line_def = line_def
+            self.axis_sensors = self.make_axis_sensors(line_def)
+            for line_offset, state in self.line_state.items():
+                state.update(line_state[line_offset])
+            if self.segmenter is not None:
+                self.segmenter.configure(**segmenter_options)
+            if self.scan_rate is not None:
+                self.scan_rate.configure(**scan_rate_options)
+            if self.trigger is not None:
+                self.trigger.configure(**trigger_options)
+                self.trigger.groups = self.trigger_groups
+        return apply
+
+    @property
+    def lines(self):
+        """ Converts keys of self.line_def to tuple """
+        return tuple(self.line_def.keys())
+
+    @property
+    def trigger_groups(self):
+        """
+        Trigger groups, lists of (trigger line, echo line) pairs fired together, in firing order.
+
+        Sensors with a group in config form the groups of that number first. The others join the first
+        group all of whose sensors are at least [trigger] crosstalk_cm away, by x/y position; without
+        a position or with crosstalk_cm=0 a sensor is fired alone. The scan takes one echo time per
+        group, so it stays the same as long as added sensors are spread out.
+        """
+        crosstalk_cm = self.config.getfloat('trigger', 'crosstalk_cm', fallback=0)
+        numbered = {}
+        placed = []  # [(pairs, lines)] of the position based groups
+        for echo_line, line in self.line_def.items():
+            if 'trg_line' not in line:
+                continue
+            pair = (line['trg_line'], echo_line)
+            if line['group'] is not None:
+                numbered.setdefault(line['group'], []).append(pair)
+                continue
+            if crosstalk_cm and line['x'] is not None and line['y'] is not None:
+                for pairs, lines in placed:
+                    if all(other is not None and other['x'] is not None and other['y'] is not None and
+                           math.hypot(line['x'] - other['x'], line['y'] - other['y']) >= crosstalk_cm
+                           for other in lines):
+                        pairs.append(pair)
+                        lines.append(line)
+                        break
+                else:
+                    placed.append(([pair], [line]))
+            else:
+                placed.append(([pair], [None]))
+        return [numbered[group] for group in sorted(numbered)] + [pairs for pairs, _ in placed]
+
+    def start_trigger(self):
+        """ Start the trigger scheduler in the running loop if enabled in config """
+        if not self.config.getboolean('trigger', 'enabled', fallback=False) or not self.trigger_groups:
+            return None
+        self.trigger = r3d_trigger.R3DTrigger(self.chip_name, self.trigger_groups, rate=self.scan_rate,
+                                              **self.trigger_options(self.config))
+        self.trigger.start()
+        return self.trigger
+
+    def event_handler(self, line_offset, event):
+        # logging.debug(f"Edge detected on line {line_offset}, Event: {event.event_type}")
+        line = self.line_state[line_offset]
+        if event.event_type == event.Type.RISING_EDGE:
+            line.rising(event.timestamp_ns)
+        elif event.event_type == event.Type.FALLING_EDGE:
+            if self.trigger is not None:
+                self.trigger.echo_done(line_offset)
+            if self.scan_rate is not None and line.state == r3d_measure.WAIT_FALL:
+                self.scan_echo(line_offset, line, event.timestamp_ns - line.rising_ns)
+            if line.falling(event.timestamp_ns):
+                self.size_ready(line_offset, line, event.timestamp_ns)
+
+    def event_batch(self, batch):
+        """
+        Edge events of a whole read batch: edges are paired and pulse widths computed per line
+        with array operations, then the echoes are fed to the estimators in time order.
+
+        :param batch: numpy structured array with timestamp_ns, line_offset and event_type fields,
+                      in kernel order; lines of other stations are ignored.
+        """
+        import numpy
+
+        line_state = self.line_state
+        offsets = batch['line_offset']
+        selected = numpy.isin(offsets, self.line_array)
+        offsets = offsets[selected]
+        timestamps = batch['timestamp_ns'][selected].astype(numpy.int64)
+        rising = batch['event_type'][selected] == RISING
+        # rising edges of the previous batch go first
+        carried = [line_offset for line_offset, line in line_state.items() if line.state == r3d_measure.WAIT_FALL]
+        if carried:
+            offsets = numpy.concatenate((carried, offsets))
+            timestamps = numpy.concatenate(([line_state[line_offset].rising_ns for line_offset in carried],
+                                            timestamps))
+            rising = numpy.concatenate((numpy.ones(len(carried), dtype=bool), rising))
+        if not len(offsets):
+            return
+
+        # group the edges by line, in kernel order within a line
+        order = numpy.argsort(offsets, kind='stable')
+        offsets, timestamps, rising = offsets[order], timestamps[order], rising[order]
+        same = offsets[1:] == offsets[:-1]
+        group = numpy.concatenate(((0,), numpy.cumsum(~same)))
+        groups = int(group[-1]) + 1
+        starts = numpy.flatnonzero(rising[:-1] & ~rising[1:] & same)
+        widths = timestamps[starts + 1] - timestamps[starts]
+        keep = widths < r3d_measure.ECHO_TIMEOUT_NS
+        timeouts = numpy.bincount(group[starts][~keep], minlength=groups)
+        filtered = None
+        if self.pulse_filter is not None:
+            min_ns, max_ns = self.pulse_filter
+            in_range = (widths >= min_ns) & (widths < max_ns)
+            filtered = numpy.bincount(group[starts][keep & ~in_range], minlength=groups)
+            keep &= in_range
+        dup_rising = numpy.bincount(group[:-1][rising[:-1] & rising[1:] & same], minlength=groups)
+        falling = numpy.bincount(group[~rising], minlength=groups)
+        paired = numpy.bincount(group[starts], minlength=groups)
+        last = numpy.concatenate((numpy.flatnonzero(~same), (len(offsets) - 1,)))
+
+        for num, end in enumerate(last.tolist()):
+            line_offset = int(offsets[end])
+            line = line_state[line_offset]
+            line.dup_rising += int(dup_rising[num])
+            line.no_rising += int(falling[num] - paired[num])
+            line.timeouts += int(timeouts[num])
+            if filtered is not None:
+                self.filtered[line_offset] += int(filtered[num])
+            if rising[end]:
+                line.state = r3d_measure.WAIT_FALL
+                line.rising_ns = int(timestamps[end])
+            else:
+                line.state = r3d_measure.IDLE
+            if falling[num] and self.trigger is not None:
+                self.trigger.echo_done(line_offset)
+
+        # the echoes of all lines in time order, as the per event path sees them
+        starts = starts[keep]
+        fall_ns = timestamps[starts + 1]
+        order = numpy.argsort(fall_ns, kind='stable')
+        scan_rate = self.scan_rate
+        for timestamp_ns, width_ns, line_offset in zip(fall_ns[order].tolist(), widths[keep][order].tolist(),
+                                                       offsets[starts][order].tolist()):
+            line = line_state[line_offset]
+            if scan_rate is not None:
+                self.scan_echo(line_offset, line, width_ns)
+            if line.echo(width_ns):
+                self.size_ready(line_offset, line, timestamp_ns)
+
+    def scan_echo(self, line_offset, line, width_ns):
+        """ A raw echo for the scan rate: an idle scan bursts on the first deviating echo """
+        if self.scan_rate.mode != r3d_trigger.BURST and width_ns < r3d_measure.ECHO_TIMEOUT_NS:
+            self.scan_rate.echo(self.line_def[line_offset]['sensor'], line.size_of(width_ns))
+
+    def size_ready(self, line_offset, line, timestamp_ns):
+        """ A new size of a line: close the box session or write the box when all axes have a size """
+        sensor = self.line_def[line_offset]['sensor']
+        if self.segmenter is not None:
+            session = self.segmenter.update(sensor, line.size_mm, timestamp_ns)
+            if self.scan_rate is not None:
+                self.scan_rate.reading(sensor, line.size_mm, busy=self.segmenter.session is not None)
+                if session is not None:
+                    self.scan_rate.departed()
+            line.size_mm = None
+            if session is not None:
+                self.pg_write(session.box_id, *self.fuse(session.size()),
+                              weight=self.weight_between(session.opened_ns, session.closed_ns))
+            return
+        if self.scan_rate is not None:
+            self.scan_rate.reading(sensor, line.size_mm)
+        for state in self.states:
+            if state.size_mm is None:
+                return
+        if self.scan_rate is not None and not self.scan_rate.record(
+                {line['sensor']: state.size_mm for line, state in zip(self.line_def.values(), self.states)}):
+            # the empty table or the box recorded last: nothing new to write
+            for state in self.states:
+                state.size_mm = None
+            return
+        sizes = {}
+        for line, state in zip(self.line_def.values(), self.states):
+            sizes[line['sensor']] = state.size_mm / 10
+            state.size_mm = None
+        self.pg_write(self.box_ids.next(), *self.fuse(sizes),
+                      weight=self.weight_between(timestamp_ns - self.scale_window_ns, timestamp_ns))
+
+    def fuse(self, sizes):
+        """
+        Per axis size of the sensor sizes, by the fuse option of the axis section (max by default).
+
+        :param sizes: {sensor: size cm or None}.
+        :return: ({axis: size cm or None}, profile) where profile is None with one sensor per axis, else
+                 JSON of the per axis min, max and sensor sizes and a height map [[x, y, height], ...]
+                 of the height sensors with a position.
+        """
+        size = {}
+        profile = {}
+        for axis, sensors in self.axis_sensors.items():
+            values = [sizes[sensor] for sensor in sensors if sizes.get(sensor) is not None]
+            if len(sensors) == 1:
+                size[axis] = values[0] if values else None
+                continue
+            fuse = self.config.get(self.prefix + axis, 'fuse', fallback='max')
+            size[axis] = round(FUSE[fuse](values), 1) if values else None
+            profile[axis] = {'min': min(values, default=None), 'max': max(values, default=None),
+                             'sensors': [sizes.get(sensor) for sensor in sensors]}
+        if not profile:
+            return size, None
+        height_map = [[line['x'], line['y'], sizes.get(line['sensor'])] for line in self.line_def.values()
+                      if line['axis'] == 'height' and line['x'] is not None and line['y'] is not None]
+        if height_map:
+            profile['height_map'] = height_map
+        return size, json.dumps(profile, separators=(',', ':'))
+
+    def resync(self, line_offset, lost):
+        """ Events of the line were lost, drop its partial measurement instead of pairing wrong edges """
+        self.line_state[line_offset].resync(lost)
+
+    @property
+    def line_stats(self):
+        """ Per line counters of echoes, timeouts and unpaired edges """
+        return {state.name: state.stats for state in self.states}
+
+    def supply_box_id(self, box_id):
+        """ Use an external id (barcode etc.) for the next box """
+        self.box_ids.supply(box_id)
+
+    def weight_between(self, start_ns, end_ns):
+        """ Weight sampled during a measurement, None without a scale """
+        if self.scale is None:
+            return None
+        return self.scale.weight_between(start_ns, end_ns)
+
+    def pg_write(self, box_id, size, profile=None, weight=None):
+        """ hand results over to the writer and the subscribers, never blocks """
+        logging.debug('%s %s: %s, weight=%s', self.name, box_id, size, weight)
+        if not self.writer.put((box_id, size['length'], size['width'], size['height'], weight, self.name,
+                                profile)):
+            logging.warning('writer queue full, record dropped: %s %s %s', self.name, box_id, size)
+
+    def prewarm(self, echoes=64):
+        """ Run synthetic echoes through throwaway line states, the estimator code is warm before the first box """
+        for line in self.make_line_state(self.config, self.line_def).values():
+            width_ns = line.base_ns // 2
+            for num in range(echoes):
+                line.rising(num * 100_000_000)
+                line.falling(num * 100_000_000 + width_ns)
+
+    def stop(self):
+        """ Stop the station threads """
+        if self.scale is not None:
+            self.scale.stop()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+""" HC-SR04 trigger scheduler """
+
+import asyncio
+import logging
+import time
+
+import gpiod
+from gpiod.line import Direction, Value
+
+
+IDLE = 'idle'
+HOLD = 'hold'
+BURST = 'burst'
+
+
+class ScanRate:
+    def __init__(self, sensors, idle_rate=2, idle_cm=2.0, skip_unchanged=False):
+        """
+        Initialize the ScanRate.
+
+        The scan bursts at the full rate while the readings deviate from the reference: the empty
+        table (sizes 0, the distances are the base values) or the sizes of the last recorded box.
+        A single deviating echo is enough, the line does not have to converge first.
+        Once a full cycle of readings matches it again, the scan drops to idle_rate: IDLE with
+        an empty table, HOLD with a measured box still on it.
+
+        :param sensors: Sensor names of the station, r3d_station line_def 'sensor'.
+        :param idle_rate: Cycles per second when nothing changes.
+        :param idle_cm: Max deviation from the reference which is no change.
+        :param skip_unchanged: Do not record the empty table and the box recorded last again.
+        """
+        self.sensors = frozenset(sensors)
+        self.configure(idle_rate, idle_cm, skip_unchanged)
+        self.reference = None  # {sensor: size mm} of the recorded box, None for the empty table
+        self.matched = set()
+        self.mode = BURST
+        self.stats = {'bursts': 0, 'skipped': 0}
+
+    def configure(self, idle_rate=2, idle_cm=2.0, skip_unchanged=False):
+        """Set the idle rate and threshold, takes effect with the next cycle."""
+        self.idle_period = 1.0 / idle_rate
+        self.idle_mm = int(round(idle_cm * 10))
+        self.skip_unchanged = skip_unchanged
+
+    def _deviates(self, sensor, size_mm):
+        if self.reference is None:
+            return size_mm > self.idle_mm
+        return abs(size_mm - self.reference.get(sensor, 0)) > self.idle_mm
+
+    def _burst(self, sensor, size_mm):
+        if self.mode != BURST:
+            self.mode = BURST
+            self.stats['bursts'] += 1
+            logging.debug('scan burst, %s at %d mm', sensor, size_mm)
+        self.matched.clear()
+
+    def echo(self, sensor, size_mm):
+        """
+        A single echo of a sensor, before its line has converged: a deviation switches to burst at once.
+
+        :param size_mm: Size of this echo alone.
+        """
+        if self.mode != BURST and self._deviates(sensor, size_mm):
+            self._burst(sensor, size_mm)
+
+    def reading(self, sensor, size_mm, busy=False):
+        """
+        A new size of a sensor: a deviation switches to burst at once.
+
+        :param busy: Keep bursting, e.g. while a box session is open.
+        """
+        if busy or self._deviates(sensor, size_mm):
+            self._burst(sensor, size_mm)
+            return
+        self.matched.add(sensor)
+        if self.mode == BURST and self.matched == self.sensors:
+            self.mode = IDLE if self.reference is None else HOLD
+            self.matched.clear()
+            logging.debug('scan %s', self.mode)
+
+    def record(self, sizes_mm):
+        """
+        All sensors have converged: decide whether it is a new box.
+
+        :param sizes_mm: {sensor: size mm}.
+        :return: False for the empty table or the box recorded last with skip_unchanged, nothing to write.
+        """
+        if all(size_mm <= self.idle_mm for size_mm in sizes_mm.values()):
+            self.reference = None
+            new = False
+        elif self.reference is not None and not any(self._deviates(sensor, size_mm)
+                                                    for sensor, size_mm in sizes_mm.items()):
+            new = False
+        else:
+            self.reference = dict(sizes_mm)
+            new = True
+        self.mode = IDLE if self.reference is None else HOLD
+        self.matched.clear()
+        if not new and self.skip_unchanged:
+            self.stats['skipped'] += 1
+            return False
+        return True
+
+    def departed(self):
+        """ The box session closed (stream mode), the table is expected empty """
+        self.reference = None
+
+    @property
+    def period(self):
+        """ Min cycle period, seconds, 0 while bursting """
+        return 0.0 if self.mode == BURST else self.idle_period
+
+
+class R3DTrigger:
+    def __init__(self, chip_name, groups, pulse_us=10, echo_timeout_ms=38, settle_ms=2, cycle_rate=0, rate=None):
+        """
+        Initialize the R3DTrigger.
+
+        Sensors are pinged a group at a time, the sensors of a group are far enough apart
+        not to hear each other and fire together. The next group is pinged as soon as the
+        echoes of the previous one are complete (falling edge on their echo lines) or the
+        no-echo timeout has passed.
+
+        :param chip_name: The GPIO chip name (e.g., 'gpiochip0').
+        :param groups: A list of groups, lists of (trigger line, echo line) pairs, in ping order;
+                       r3d_station.Station.trigger_groups.
+        :param pulse_us: Trigger pulse width, microseconds.
+        :param echo_timeout_ms: Max echo pulse width, the sensor gives up after 38 ms.
+        :param settle_ms: Pause after an echo before the next ping, lets reflections die out.
+        :param cycle_rate: Max full cycles (all groups) per second, 0 is unlimited.
+        :param rate: ScanRate slowing the scan down to its idle rate while nothing changes, or None.
+        """
+        self.chip_name = chip_name
+        self.groups = [list(group) for group in groups]
+        self.rate = rate
+        self.configure(pulse_us, echo_timeout_ms, settle_ms, cycle_rate)
+        self.stats = {'pings': 0, 'echoes': 0, 'timeouts': 0, 'cycles': 0}
+        self.task = None
+
+        pairs = [pair for group in self.groups for pair in group]
+        self._echo_events = {echo_line: asyncio.Event() for _, echo_line in pairs}
+        self.request = gpiod.request_lines(self.chip_name, consumer="ruler3d-trigger",
+                                           config={
+                                               tuple(trg for trg, _ in pairs): gpiod.LineSettings(
+                                                   direction=Direction.OUTPUT, output_value=Value.INACTIVE)
+                                           }
+                                           )
+
+    def configure(self, pulse_us=10, echo_timeout_ms=38, settle_ms=2, cycle_rate=0):
+        """Set the timing, takes effect with the next ping."""
+        self.pulse_ns = int(pulse_us * 1000)
+        self.echo_timeout = echo_timeout_ms / 1000.0
+        self.settle = settle_ms / 1000.0
+        self.cycle_period = 1.0 / cycle_rate if cycle_rate else 0.0
+
+    def echo_done(self, echo_line):
+        """Called on the falling edge of an echo line."""
+        event = self._echo_events.get(echo_line)
+        if event is not None:
+            event.set()
+
+    def _pulse(self, trg_lines):
+        """Send a trigger pulse on all lines at once, a busy wait is the only way to get ~10 us."""
+        self.request.set_values(dict.fromkeys(trg_lines, Value.ACTIVE))
+        end_ns = time.perf_counter_ns() + self.pulse_ns
+        while time.perf_counter_ns() < end_ns:
+            pass
+        self.request.set_values(dict.fromkeys(trg_lines, Value.INACTIVE))
+
+    async def ping(self, group):
+        """
+        Ping the sensors of a group and wait for their echoes.
+
+        :param group: A list of (trigger line, echo line) pairs.
+        :return: False if an echo timed out.
+        """
+        loop = asyncio.get_running_loop()
+        events = [self._echo_events[echo_line] for _, echo_line in group]
+        for event in events:
+            event.clear()
+        self._pulse([trg_line for trg_line, _ in group])
+        self.stats['pings'] += len(group)
+        # the echo lines rise ~0.5 ms after the trigger and fall at most echo_timeout later
+        deadline = loop.time() + self.echo_timeout + 0.005
+        echoes = 0
+        for event in events:
+            if not event.is_set():
+                try:
+                    await asyncio.wait_for(event.wait(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    continue
+            echoes += 1
+        self.stats['echoes'] += echoes
+        self.stats['timeouts'] += len(events) - echoes
+        return echoes == len(events)
+
+    async def _scan(self):
+        """Ping the groups in turn, forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            cycle_start = loop.time()
+            for group in self.groups:
+                await self.ping(group)
+                await asyncio.sleep(self.settle)
+            self.stats['cycles'] += 1
+            period = self.cycle_period
+            if self.rate is not None:
+                period = max(period, self.rate.period)
+            if period:
+                await asyncio.sleep(max(0.0, cycle_start + period - loop.time()))
+
+    def start(self):
+        """Start the scan task in the running loop."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._scan())
+
+    async def aclose(self):
+        """Stop the scan task and release the trigger lines."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.request.release()
+        logging.info('trigger stats: %s', self.stats)
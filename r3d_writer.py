@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+""" Background batched writer of ruler3d records to PostgreSQL """
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import r3d_journal
+
+R3D_COLUMNS = ('box_id', 'length', 'width', 'height', 'weight', 'station', 'profile')
+
+INS_R3D_BATCH = f"""INSERT INTO shp.ruler3d ({', '.join(R3D_COLUMNS)})
+VALUES %s;
+"""
+
+
+class R3DWriter:
+    def __init__(self, pg, queue_size=1024, batch_size=100, flush_interval=0.5,
+                 journal=None, replay_batch=5000, retry_interval=5.0):
+        """
+        Initialize the R3DWriter.
+
+        Without a journal a batch is kept in memory until the database takes it.
+        With a journal every batch is appended to it first, then the journal is
+        replayed into the database in large transactions whenever it is reachable.
+
+        :param pg: pg_app.PGapp instance, its connection is used by the writer thread only.
+        :param queue_size: Max number of records waiting for the database.
+        :param batch_size: Flush as soon as this many records are collected.
+        :param flush_interval: Flush a non-empty batch after this many seconds.
+        :param journal: Journal file name or None.
+        :param replay_batch: Max number of journal records per replay transaction.
+        :param retry_interval: Seconds between attempts to reach the database.
+        """
+        self.pg = pg
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_batch = replay_batch
+        self.retry_interval = retry_interval
+        self.running = True
+        self.stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'written': 0,
+            'batches': 0,
+            'failed': 0,
+            'max_depth': 0,
+            'journaled': 0,
+            'backlog': 0,
+        }
+        self.last_write = None  # time.time() of the last successful write
+        # optional r3d_metrics.Histogram of seconds from put() to commit in PG
+        self.latency = None
+
+        self.journal = None
+        if journal:
+            self.journal = r3d_journal.R3DJournal(journal, R3D_COLUMNS)
+
+        self.thread = threading.Thread(target=self._worker, name='r3d-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        """
+        Enqueue a record without blocking the caller.
+
+        :param record: A tuple of values in R3D_COLUMNS order.
+        :return: False if the queue is full and the record is dropped.
+        """
+        try:
+            self.queue.put_nowait((time.time(), record))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+        self.stats['enqueued'] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats['max_depth']:
+            self.stats['max_depth'] = depth
+        return True
+
+    def _collect(self, batch):
+        """Wait up to flush_interval for records, return when the batch is full or the time is out."""
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            # drain what is already there without waiting
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+        return batch
+
+    def _worker(self):
+        """Collect records into batches and flush them on size or time threshold."""
+        batch = []
+        next_try = 0.0
+        while True:
+            stopping = not self.running
+            if len(batch) >= self.batch_size:
+                # database is down and nowhere to put more: let the queue apply backpressure
+                time.sleep(max(0.0, min(self.flush_interval, next_try - time.monotonic())))
+            self._collect(batch)
+            if batch and self.journal is not None:
+                try:
+                    self.journal.append(batch)
+                except Exception as exc:  # disk full, broken file: keep the batch in memory
+                    logging.error('journal append failed: %s', exc)
+                else:
+                    self.stats['journaled'] += len(batch)
+                    batch = []
+
+            if time.monotonic() >= next_try:
+                if self.journal is not None:
+                    done = self._replay()
+                else:
+                    done = not batch or self._flush(batch)
+                    if done:
+                        batch = []
+                if not done:
+                    next_try = time.monotonic() + self.retry_interval
+
+            if stopping and self.queue.empty():
+                break
+
+        if batch:
+            logging.error('writer stopped, %d records lost', len(batch))
+        if self.journal is not None:
+            logging.info('writer stopped, journal backlog=%d', self.journal.backlog())
+            self.journal.close()
+
+    def _connect(self):
+        """ (Re)connect to PG if needed """
+        conn = getattr(self.pg, 'conn', None)
+        if conn is None or conn.closed:
+            if not self.pg.pg_connect():
+                raise psycopg2.OperationalError('pg_connect failed')
+            self.pg.set_session(autocommit=True)
+
+    def _disconnect(self):
+        """ Drop a broken connection, the next attempt reconnects """
+        conn = getattr(self.pg, 'conn', None)
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def _written(self, timestamps):
+        """ Account records committed to PG """
+        self.last_write = time.time()
+        self.stats['written'] += len(timestamps)
+        self.stats['batches'] += 1
+        if self.latency is not None:
+            for put_ts in timestamps:
+                self.latency.observe(self.last_write - put_ts)
+
+    def _flush(self, batch):
+        """ Insert the batch as one multi-row INSERT """
+        try:
+            self._connect()
+            psycopg2.extras.execute_values(self.pg.curs, INS_R3D_BATCH, [rec for _, rec in batch],
+                                           page_size=len(batch))
+        except psycopg2.Error as exc:
+            self.stats['failed'] += 1
+            logging.warning('batch of %d records not written: %s', len(batch), exc)
+            self._disconnect()
+            return False
+        self._written([put_ts for put_ts, _ in batch])
+        logging.debug('written batch of %d records', len(batch))
+        return True
+
+    def _replay(self):
+        """ Drain the journal into PG, one transaction per replay_batch records """
+        while True:
+            try:
+                pending = self.journal.pending(self.replay_batch)
+            except sqlite3.Error as exc:  # locked, broken file: retry like a PG failure
+                self.stats['failed'] += 1
+                logging.warning('journal read failed: %s', exc)
+                return False
+            if not pending:
+                return True
+            records = [rec for _, _, rec in pending]
+            try:
+                self._connect()
+                self.pg.curs.execute('BEGIN')
+                psycopg2.extras.execute_values(self.pg.curs, INS_R3D_BATCH, records, page_size=1000)
+                self.pg.curs.execute('COMMIT')
+            except psycopg2.Error as exc:
+                self.stats['failed'] += 1
+                self.stats['backlog'] = self.journal.backlog()
+                logging.warning('journal replay failed, backlog=%d: %s', self.stats['backlog'], exc)
+                self._disconnect()
+                return False
+            self._written([put_ts for _, put_ts, _ in pending])
+            # a crash right here replays the batch once more: at-least-once delivery
+            try:
+                self.journal.checkpoint(pending[-1][0])
+                self.stats['backlog'] = self.journal.backlog()
+            except sqlite3.Error as exc:
+                self.stats['failed'] += 1
+                logging.warning('journal checkpoint failed, the batch is replayed again: %s', exc)
+                return False
+            logging.debug('replayed %d records from journal', len(records))
+            if not self.running or not self.queue.empty():
+                # do not hold up fresh records or shutdown, the rest stays in the journal
+                return True
+
+    def stop(self, timeout=5.0):
+        """Flush pending records and stop the writer thread."""
+        self.running = False
+        self.thread.join(timeout)
+        logging.info('writer stats: %s', self.stats)
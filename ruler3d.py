@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 
+import asyncio
+import configparser
+import datetime
+import logging
+import os
+import signal
 import time
 import gpiod
 import threading
@@ -7,9 +13,41 @@ import threading
 import log_app
 import pg_app
 
+# r3d_metrics, r3d_record and r3d_shm are imported when enabled, startup does not wait for them
+import r3d_measure
+import r3d_station
+import r3d_writer
+
+
+def process_start_ns():
+    """ Process start time on the CLOCK_MONOTONIC scale of edge timestamps, 10 ms resolution, None if unknown """
+    try:
+        with open('/proc/self/stat') as file:
+            # the fields after the command name, starttime is field 22
+            starttime = int(file.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+    start_boot_ns = starttime * 1_000_000_000 // os.sysconf('SC_CLK_TCK')
+    return time.monotonic_ns() - (time.clock_gettime_ns(time.CLOCK_BOOTTIME) - start_boot_ns)
+
+
+PROCESS_START_NS = process_start_ns()
+
+
+class ChipNotFoundError(FileNotFoundError):
+    """ The GPIO chip of the echo lines does not exist, no hardware: the emulator mode takes over """
+
+
+# numpy dtype of the arrays passed to batch callbacks
+BATCH_DTYPE = [('timestamp_ns', '<u8'), ('line_offset', '<u4'), ('event_type', 'u1')]
+
 
 class GPIOEventHandler:
-    def __init__(self, chip_name, line_numbers, edge_type, callback):
+    WAIT_TIMEOUT = 0.5  # sec
+
+    def __init__(self, chip_name, line_numbers, edge_type, callback, event_buffer_size=None, max_events=None,
+                 gap_callback=None, bias=None, debounce=None, pulse_filter=None, batch_callback=None,
+                 recorder=None, realtime=None):
         """
         Initialize the GPIOEventHandler.
 
@@ -17,12 +55,27 @@ class GPIOEventHandler:
         :param line_numbers: A list of GPIO line numbers to monitor.
         :param edge_type: The edge type to detect ('rising', 'falling', 'both').
         :param callback: The callback function to execute on edge detection.
+        :param event_buffer_size: Kernel event FIFO size, None is the kernel default (16 per line).
+        :param max_events: Max events per read, None is the gpiod default.
+        :param gap_callback: Called as gap_callback(line_offset, lost) when events of a line were lost.
+        :param bias: gpiod.line.Bias of the lines, None leaves it as is.
+        :param debounce: {line offset: kernel debounce period, us}, lines not in it are not debounced.
+        :param pulse_filter: (min, max) pulse width in ns: pulses out of range are dropped before the callback,
+                             None passes all edges.
+        :param batch_callback: Called with each read batch as a numpy array of BATCH_DTYPE instead of
+                               callback per event; pulse_filter is then up to the batch callback.
+        :param recorder: r3d_record.ChipRecorder the edges are recorded to as read, before the pulse filter.
+        :param realtime: r3d_realtime.apply() arguments of the listener thread, None keeps the normal priority.
         """
         self.chip_name = chip_name
         self.line_numbers = line_numbers
         self.edge_type = edge_type
         self.callback = callback
         self.running = True
+        self.bias = bias
+        self.debounce = debounce or {}
+        self.realtime = realtime
+        self._init_dispatch(event_buffer_size, max_events, gap_callback, pulse_filter, batch_callback, recorder)
 
         # Open the GPIO chip
         self.chip = gpiod.Chip(chip_name)
@@ -35,8 +88,39 @@ class GPIOEventHandler:
         self.event_thread.daemon = True
         self.event_thread.start()
 
-    def _configure_lines(self):
-        """Configure the GPIO lines for edge detection."""
+    def _init_dispatch(self, event_buffer_size, max_events, gap_callback, pulse_filter=None, batch_callback=None,
+                       recorder=None):
+        """Set up event reading, seqno tracking, recording and the pulse filter."""
+        self.event_buffer_size = event_buffer_size
+        self.max_events = max_events
+        self.gap_callback = gap_callback
+        self.pulse_filter = pulse_filter
+        self.batch_callback = batch_callback
+        self.recorder = recorder
+        self.numpy = None
+        if batch_callback is not None:
+            import numpy
+
+            self.numpy = numpy
+        # rising edges held back by the pulse filter until their falling edge
+        self.held = {}
+        self.filtered = dict.fromkeys(self.line_numbers, 0)
+        # seqnos of the last events read, the kernel numbers events from 1
+        self.global_seqno = 0
+        self.line_seqno = dict.fromkeys(self.line_numbers, 0)
+        self.lost = dict.fromkeys(self.line_numbers, 0)
+        self.lost_global = 0
+        # optional r3d_metrics.Histogram of callback duration, ns
+        self.callback_duration = None
+        # timestamp of the first edge, ns
+        self.first_edge_ns = None
+        # wakeup latency, from the kernel timestamp of the oldest event of a read to its dispatch, ns
+        self.wakeup_max_ns = 0
+        # optional r3d_metrics.Histogram of the wakeup latency, ns
+        self.wakeup_latency = None
+
+    def _line_settings(self, debounce_us=0):
+        """LineSettings of the monitored lines."""
         # Define edge event type
         if self.edge_type == 'rising':
             event_type = gpiod.line.Edge.RISING
@@ -46,22 +130,196 @@ class GPIOEventHandler:
             event_type = gpiod.line.Edge.BOTH
         else:
             raise ValueError("Invalid edge_type. Use 'rising', 'falling', or 'both'.")
+        settings = {'edge_detection': event_type}
+        if self.bias is not None:
+            settings['bias'] = self.bias
+        if debounce_us:
+            settings['debounce_period'] = datetime.timedelta(microseconds=debounce_us)
+        return gpiod.LineSettings(**settings)
+
+    def _line_config(self):
+        """Line settings of the monitored lines, grouped by debounce period."""
+        groups = {}
+        for line in self.line_numbers:
+            groups.setdefault(self.debounce.get(line, 0), []).append(line)
+        return {tuple(lines): self._line_settings(debounce_us) for debounce_us, lines in groups.items()}
 
+    def _configure_lines(self):
+        """Configure the GPIO lines for edge detection."""
         # Request lines with event detection
         self.request = gpiod.request_lines(self.chip_name, consumer="watch-lines-edge",
-                                           config={
-                                               self.line_numbers: gpiod.LineSettings(edge_detection=event_type)
-                                           }
+                                           config=self._line_config(),
+                                           event_buffer_size=self.event_buffer_size
                                            )
 
+    def reconfigure(self, bias=None, debounce=None, pulse_filter=None):
+        """
+        Change the line settings in place, the lines stay requested and no events are lost.
+
+        :param bias: gpiod.line.Bias of the lines, None leaves it as is.
+        :param debounce: {line offset: kernel debounce period, us}.
+        :param pulse_filter: (min, max) pulse width in ns or None.
+        """
+        self._set_pulse_filter(pulse_filter)
+        debounce = debounce or {}
+        if bias == self.bias and debounce == self.debounce:
+            return
+        self.bias = bias
+        self.debounce = debounce
+        self.request.reconfigure_lines(config=self._line_config())
+        logging.info('%s lines %s reconfigured', self.chip_name, self.line_numbers)
+
+    def _set_pulse_filter(self, pulse_filter):
+        """Swap the pulse filter, held edges are passed on when it is switched off."""
+        if pulse_filter is None and self.held:
+            held = sorted(self.held.values(), key=lambda event: event.timestamp_ns)
+            self.held = {}
+            for event in held:
+                self._call(event)
+        self.pulse_filter = pulse_filter
+
+    def _gap(self, event):
+        """Events of the line were lost by the kernel FIFO: report and let the consumer resync."""
+        lost = event.line_seqno - self.line_seqno[event.line_offset] - 1
+        self.lost[event.line_offset] += lost
+        # a held rising edge can not be paired across the gap
+        self.held.pop(event.line_offset, None)
+        logging.warning('line %d: %d events lost', event.line_offset, lost)
+        if self.gap_callback is not None:
+            self.gap_callback(event.line_offset, lost)
+
+    def _first_edge(self, event):
+        """Note the time from process start to the first edge."""
+        self.first_edge_ns = event.timestamp_ns
+        self._first_edge_log()
+
+    def _first_edge_log(self):
+        if PROCESS_START_NS is not None:
+            logging.info('%s: first edge %.3f sec after process start', self.chip_name,
+                         (self.first_edge_ns - PROCESS_START_NS) / 1e9)
+
+    def _wakeup(self, timestamp_ns):
+        """Account the wakeup latency of a read, its jitter is what real-time mode is about."""
+        latency_ns = time.monotonic_ns() - timestamp_ns
+        if latency_ns > self.wakeup_max_ns:
+            self.wakeup_max_ns = latency_ns
+        if self.wakeup_latency is not None:
+            self.wakeup_latency.observe(latency_ns)
+
+    def _dispatch(self, events):
+        """Check seqno continuity and run the callback on each event."""
+        if not events:
+            return
+        self._wakeup(events[0].timestamp_ns)
+        if self.first_edge_ns is None:
+            self._first_edge(events[0])
+        if self.batch_callback is not None:
+            self._dispatch_batch(events)
+            return
+        callback = self.callback
+        histogram = self.callback_duration
+        line_seqno = self.line_seqno
+        recorder = self.recorder
+        for event in events:
+            if event.line_seqno != line_seqno[event.line_offset] + 1:
+                self._gap(event)
+            line_seqno[event.line_offset] = event.line_seqno
+            if event.global_seqno != self.global_seqno + 1:
+                self.lost_global += event.global_seqno - self.global_seqno - 1
+            self.global_seqno = event.global_seqno
+            if recorder is not None:
+                recorder.record(event)
+
+            if self.pulse_filter is not None:
+                # a rising edge waits for its falling edge, the pair is passed on or dropped together
+                if event.event_type == event.Type.RISING_EDGE:
+                    held = self.held.get(event.line_offset)
+                    self.held[event.line_offset] = event
+                    if held is None:
+                        continue
+                    # the falling edge of the held one was lost, let the callback see it
+                    event = held
+                else:
+                    held = self.held.pop(event.line_offset, None)
+                    if held is not None:
+                        min_ns, max_ns = self.pulse_filter
+                        width_ns = event.timestamp_ns - held.timestamp_ns
+                        # no echo is passed on, the callback counts it as a timeout
+                        if width_ns < r3d_measure.ECHO_TIMEOUT_NS and not min_ns <= width_ns < max_ns:
+                            self.filtered[event.line_offset] += 1
+                            continue
+                        self._call(held)
+                self._call(event)
+                continue
+
+            if callback is None:
+                continue
+            if histogram is None:
+                callback(event.line_offset, event)
+            else:
+                started = time.perf_counter_ns()
+                callback(event.line_offset, event)
+                histogram.observe(time.perf_counter_ns() - started)
+
+    def _dispatch_batch(self, events):
+        """Check seqno continuity, pass the events to the batch callback, split at gaps."""
+        line_seqno = self.line_seqno
+        start = 0
+        for num, event in enumerate(events):
+            if event.line_seqno != line_seqno[event.line_offset] + 1:
+                # the events before the gap are processed before the consumer resyncs
+                if num > start:
+                    self._call_batch(events[start:num])
+                    start = num
+                self._gap(event)
+            line_seqno[event.line_offset] = event.line_seqno
+            if event.global_seqno != self.global_seqno + 1:
+                self.lost_global += event.global_seqno - self.global_seqno - 1
+            self.global_seqno = event.global_seqno
+        if start < len(events):
+            self._call_batch(events[start:])
+
+    def _call_batch(self, events):
+        """Run the batch callback on events as one array."""
+        batch = self.numpy.fromiter(((event.timestamp_ns, event.line_offset, event.event_type.value)
+                                     for event in events), dtype=BATCH_DTYPE, count=len(events))
+        self._call_array(batch)
+
+    def _call_array(self, batch):
+        """Run the batch callback, timed per event if there is a histogram."""
+        histogram = self.callback_duration
+        if histogram is None:
+            self.batch_callback(batch)
+        else:
+            started = time.perf_counter_ns()
+            self.batch_callback(batch)
+            histogram.observe((time.perf_counter_ns() - started) / len(batch))
+
+    def _call(self, event):
+        """Run the callback on an event, timed if there is a histogram."""
+        if self.callback is None:
+            return
+        histogram = self.callback_duration
+        if histogram is None:
+            self.callback(event.line_offset, event)
+        else:
+            started = time.perf_counter_ns()
+            self.callback(event.line_offset, event)
+            histogram.observe(time.perf_counter_ns() - started)
+
     def _event_listener(self):
         """Listen for GPIO edge events."""
+        if self.realtime is not None:
+            import r3d_realtime
+
+            r3d_realtime.apply(**self.realtime)
         while self.running:
-            # Block until an event occurs
-            events = self.request.read_edge_events()
+            # Block until an event occurs, wake up periodically to check self.running
+            if not self.request.wait_edge_events(timeout=self.WAIT_TIMEOUT):
+                continue
+            events = self.request.read_edge_events(self.max_events)
             if events:
-                for event in events:
-                    self.callback(event.line_offset, event)
+                self._dispatch(events)
 
     def start(self):
         """Start the event listener thread."""
@@ -72,10 +330,14 @@ class GPIOEventHandler:
             self.event_thread.start()
 
     def stop(self):
-        self.running = False
         """Stop the event listener thread."""
+        self.running = False
+        event_thread = getattr(self, 'event_thread', None)
+        if event_thread is not None and event_thread is not threading.current_thread():
+            event_thread.join(2 * self.WAIT_TIMEOUT)
         if hasattr(self, 'request'):
             self.request.release()
+            del self.request
             logging.debug('self.request released')
 
     def __del__(self):
@@ -84,9 +346,206 @@ class GPIOEventHandler:
         logging.debug('finalizer')
 
 
-INS_R3D = """INSERT INTO shp.ruler3d (box_id, length, width, height)
-VALUES (%s, %s, %s, %s);
-"""
+class AsyncGPIOEventHandler(GPIOEventHandler):
+    def __init__(self, chip_name, line_numbers, edge_type, callback=None, loop=None, event_buffer_size=None,
+                 max_events=None, gap_callback=None, bias=None, debounce=None, pulse_filter=None,
+                 batch_callback=None, recorder=None):
+        """
+        Initialize the AsyncGPIOEventHandler.
+
+        No listener thread: the line request file descriptor is registered with the event loop,
+        events are read when it is readable and delivered to the callback and the async consumers.
+
+        :param chip_name: The GPIO chip name (e.g., 'gpiochip0').
+        :param line_numbers: A list of GPIO line numbers to monitor.
+        :param edge_type: The edge type to detect ('rising', 'falling', 'both').
+        :param callback: Optional plain function called on edge detection in the loop thread.
+        :param loop: The event loop, the running loop by default.
+        :param event_buffer_size: Kernel event FIFO size, None is the kernel default (16 per line).
+        :param max_events: Max events per read, None is the gpiod default.
+        :param gap_callback: Called as gap_callback(line_offset, lost) when events of a line were lost.
+        :param bias: gpiod.line.Bias of the lines, None leaves it as is.
+        :param debounce: {line offset: kernel debounce period, us}, lines not in it are not debounced.
+        :param pulse_filter: (min, max) pulse width in ns: pulses out of range are not passed to the callback,
+                             None passes all edges. Async consumers get all edges.
+        :param batch_callback: Called with each read batch as a numpy array of BATCH_DTYPE instead of
+                               callback per event; pulse_filter is then up to the batch callback.
+        :param recorder: r3d_record.ChipRecorder the edges are recorded to as read, before the pulse filter.
+        """
+        self.chip_name = chip_name
+        self.line_numbers = line_numbers
+        self.edge_type = edge_type
+        self.callback = callback
+        self.running = False
+        self.bias = bias
+        self.debounce = debounce or {}
+        self.consumers = []
+        self.dropped = 0
+        self._init_dispatch(event_buffer_size, max_events, gap_callback, pulse_filter, batch_callback, recorder)
+
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.chip = gpiod.Chip(chip_name)
+        self._configure_lines()
+        self.start()
+
+    def _on_readable(self):
+        """Read the pending edge events, never blocks as the fd is readable."""
+        events = self.request.read_edge_events(self.max_events)
+        self._dispatch(events)
+        for consumer in self.consumers:
+            for event in events:
+                try:
+                    consumer.put_nowait(event)
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+    def subscribe(self, maxsize=1024):
+        """
+        Register an async consumer.
+
+        :param maxsize: Max number of undelivered events, newer ones are dropped.
+        :return: asyncio.Queue of edge events, None marks the end of the stream.
+        """
+        consumer = asyncio.Queue(maxsize=maxsize)
+        self.consumers.append(consumer)
+        return consumer
+
+    async def events(self, maxsize=1024):
+        """Iterate over edge events until the handler is stopped."""
+        consumer = self.subscribe(maxsize)
+        try:
+            while True:
+                event = await consumer.get()
+                consumer.task_done()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.consumers.remove(consumer)
+
+    def start(self):
+        """Register the line request with the event loop."""
+        if not self.running:
+            self.loop.add_reader(self.request.fd, self._on_readable)
+            self.running = True
+
+    def stop(self):
+        """Unregister from the event loop and release the lines."""
+        if self.running:
+            self.loop.remove_reader(self.request.fd)
+            self.running = False
+            for consumer in self.consumers:
+                try:
+                    consumer.put_nowait(None)
+                except asyncio.QueueFull:
+                    pass
+        if hasattr(self, 'request'):
+            self.request.release()
+            del self.request
+            logging.debug('self.request released')
+
+    async def aclose(self, timeout=1.0):
+        """Stop and give consumers up to timeout seconds to drain their queues."""
+        self.stop()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(c.join() for c in self.consumers)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning('consumers not drained in %s sec', timeout)
+
+
+class ShmEventHandler(GPIOEventHandler):
+    def __init__(self, chip_name, line_numbers, callback, gap_callback=None, bias=None, debounce=None,
+                 pulse_filter=None, batch_callback=None, recorder=None):
+        """
+        Initialize the ShmEventHandler, the processing side of a chip in split mode.
+
+        The lines are requested by the acquisition process (r3d_shm.acquire), events arrive over
+        the shared-memory ring and are checked and dispatched here as by GPIOEventHandler.
+
+        :param chip_name: The GPIO chip name (e.g., 'gpiochip0').
+        :param line_numbers: A list of GPIO line numbers to monitor.
+        :param callback: The callback function to execute on edge detection.
+        :param gap_callback: Called as gap_callback(line_offset, lost) when events of a line were lost.
+        :param bias: gpiod.line.Bias the acquisition process requests the lines with.
+        :param debounce: {line offset: kernel debounce period, us} the acquisition process requests the lines with.
+        :param pulse_filter: (min, max) pulse width in ns: pulses out of range are dropped before the callback,
+                             None passes all edges.
+        :param batch_callback: Called with the records of the ring as a numpy array instead of callback
+                               per event; pulse_filter is then up to the batch callback.
+        :param recorder: r3d_record.ChipRecorder the edges are recorded to as read, before the pulse filter.
+        """
+        self.chip_name = chip_name
+        self.line_numbers = line_numbers
+        self.callback = callback
+        self.running = False
+        self.bias = bias
+        self.debounce = debounce or {}
+        self._init_dispatch(None, None, gap_callback, pulse_filter, batch_callback, recorder)
+
+    def _dispatch_array(self, records):
+        """
+        Check seqno continuity of ring records with array operations and pass them to the batch callback.
+
+        :param records: numpy array of r3d_shm.RECORD_DTYPE, the records of this chip.
+        """
+        numpy = self.numpy
+        offsets = records['line_offset']
+        line_seqnos = records['line_seqno']
+        last = {}
+        for line_offset, seqno in self.line_seqno.items():
+            seqnos = line_seqnos[offsets == line_offset]
+            if not len(seqnos):
+                continue
+            if seqnos[0] != seqno + 1 or (len(seqnos) > 1 and (numpy.diff(seqnos) != 1).any()):
+                # rare: events lost, check and split the batch event by event
+                self._dispatch([gpiod.EdgeEvent(event_type=int(record['event_type']),
+                                                timestamp_ns=int(record['timestamp_ns']),
+                                                line_offset=int(record['line_offset']),
+                                                global_seqno=int(record['global_seqno']),
+                                                line_seqno=int(record['line_seqno'])) for record in records])
+                return
+            last[line_offset] = int(seqnos[-1])
+        self._wakeup(int(records['timestamp_ns'][0]))
+        if self.first_edge_ns is None:
+            self.first_edge_ns = int(records['timestamp_ns'][0])
+            self._first_edge_log()
+        self.line_seqno.update(last)
+        global_seqno = int(records['global_seqno'][-1])
+        self.lost_global += global_seqno - self.global_seqno - len(records)
+        self.global_seqno = global_seqno
+        self._call_array(records)
+
+    def reconfigure(self, bias=None, debounce=None, pulse_filter=None):
+        """The acquisition process owns the lines, line settings apply on restart; the filter applies here."""
+        self._set_pulse_filter(pulse_filter)
+        if bias != self.bias or (debounce or {}) != self.debounce:
+            logging.warning('split mode: line settings of %s not changed until restart', self.chip_name)
+
+    def stop(self):
+        """Nothing to release, the acquisition process owns the lines."""
+        self.running = False
+
+
+class ReplayEventHandler(GPIOEventHandler):
+    def __init__(self, chip_name, line_numbers, callback, gap_callback=None, pulse_filter=None):
+        """
+        Initialize the ReplayEventHandler, the processing side of a chip for a recording.
+
+        No line request: recorded events are passed to _dispatch and checked, filtered and
+        dispatched exactly as live ones.
+
+        :param chip_name: The GPIO chip name (e.g., 'gpiochip0').
+        :param line_numbers: A list of GPIO line numbers to monitor.
+        :param callback: The callback function to execute on edge detection.
+        :param gap_callback: Called as gap_callback(line_offset, lost) when events of a line were lost.
+        :param pulse_filter: (min, max) pulse width in ns: pulses out of range are dropped before the callback,
+                             None passes all edges.
+        """
+        self.chip_name = chip_name
+        self.line_numbers = line_numbers
+        self.callback = callback
+        self.running = False
+        self._init_dispatch(None, None, gap_callback, pulse_filter)
 
 
 class Ruler3D(log_app.LogApp, pg_app.PGapp):
@@ -95,87 +554,369 @@ class Ruler3D(log_app.LogApp, pg_app.PGapp):
         # config_filename = args.conf
         self.get_config(inline_comment_prefixes=(';', '#'))
 
+        # no connect here: the writer thread connects on its first batch, acquisition does not wait for PG
         pg_app.PGapp.__init__(self, self.config['PG']['pg_host'], self.config['PG']['pg_user'])
-        if self.pg_connect():
-            self.set_session(autocommit=True)
-
-        self.timestamp_rising = {}
-        self.dist3 = {}
-        self.size = {}
-
-        self.line_def = {
-            int(self.config['length']['line']): {
-                'base': float(self.config['length']['base']),
-                'name': self.config['length']['name']},
-            int(self.config['width']['line']): {
-                'base': float(self.config['width']['base']),
-                'name': self.config['width']['name']},
-            int(self.config['height']['line']): {
-                'base': float(self.config['height']['base']),
-                'name': self.config['height']['name']}
-        }
 
-    @property
-    def lines(self):
-        """ Converts keys of self.line_def to tuple """
-        return tuple(self.line_def.keys())
+        # one writer (one connection, batched inserts) is shared by all stations
+        self.writer = r3d_writer.R3DWriter(self,
+                                           queue_size=self.config.getint('writer', 'queue_size', fallback=1024),
+                                           batch_size=self.config.getint('writer', 'batch_size', fallback=100),
+                                           flush_interval=self.config.getfloat('writer', 'flush_interval',
+                                                                               fallback=0.5),
+                                           journal=self.config.get('writer', 'journal', fallback=None),
+                                           replay_batch=self.config.getint('writer', 'replay_batch', fallback=5000),
+                                           retry_interval=self.config.getfloat('writer', 'retry_interval',
+                                                                               fallback=5.0))
+        # completed records go to local subscribers first, the database is one consumer among them
+        self.publisher = None
+        self.sink = self.writer
+        if self.config.getboolean('publish', 'enabled', fallback=False):
+            import r3d_publish
+
+            self.publisher = r3d_publish.R3DPublisher(
+                self.config.get('publish', 'address', fallback='/run/ruler3d/records.sock'),
+                max_buffer=self.config.getint('publish', 'max_buffer', fallback=65536))
+            self.sink = r3d_publish.Fanout([self.publisher, self.writer])
+        self.setup_pipeline()
+
+    def setup_pipeline(self):
+        """ Build the stations from self.config
+
+        With [stations] names=A,B every station has a section [A] (chip_name, box_id_prefix)
+        and axis sections [A.length], [A.width], [A.height], optionally [A.scale].
+        Without it there is a single station of [length], [width], [height] and [scale].
+        """
+        self.stations = [r3d_station.Station(self.config, writer=self.sink, **spec)
+                         for spec in self.station_specs(self.config)]
+        # the filter of the batch path, the handlers filter per event
+        for station in self.stations:
+            station.pulse_filter = self.pulse_filter(self.config)
+
+        # chip name -> {line offset: station}, all lines of a chip are taken by a single request
+        self.chips = {}
+        for station in self.stations:
+            chip = self.chips.setdefault(station.chip_name, {})
+            for line_offset in station.lines:
+                if line_offset in chip:
+                    raise ValueError(f'{station.chip_name} line {line_offset} of station {station.name} '
+                                     f'is used by station {chip[line_offset].name}')
+                chip[line_offset] = station
+
+    @staticmethod
+    def station_specs(config):
+        """ Station arguments (name, chip_name, prefix, box_id_prefix) of a config """
+        names = [name.strip() for name in config.get('stations', 'names', fallback='').split(',') if name.strip()]
+        if not names:
+            return [{'name': config.get('GPIO', 'station', fallback='main'),
+                     'chip_name': config['GPIO']['chip_name'],
+                     'box_id_prefix': config.get('stream', 'box_id_prefix', fallback='')}]
+        return [{'name': name, 'chip_name': config.get(name, 'chip_name', fallback=config['GPIO']['chip_name']),
+                 'prefix': f'{name}.', 'box_id_prefix': config.get(name, 'box_id_prefix', fallback=f'{name}-')}
+                for name in names]
+
+    @staticmethod
+    def line_bias(config):
+        """ gpiod.line.Bias of the echo lines from [GPIO] bias, None if not set """
+        bias = config.get('GPIO', 'bias', fallback=None)
+        if bias is None:
+            return None
+        try:
+            return gpiod.line.Bias[bias.strip().upper().replace('-', '_')]
+        except KeyError:
+            raise ValueError(f"Invalid bias {bias}. Use 'as-is', 'disabled', 'pull-up' or 'pull-down'.") from None
+
+    @staticmethod
+    def pulse_filter(config):
+        """ (min, max) echo pulse width in ns from [GPIO] min_pulse_us / max_pulse_ms, None if not set """
+        min_ns = int(config.getfloat('GPIO', 'min_pulse_us', fallback=0) * 1000)
+        max_ns = int(config.getfloat('GPIO', 'max_pulse_ms', fallback=0) * 1_000_000)
+        if not min_ns and not max_ns:
+            return None
+        return min_ns, max_ns or r3d_measure.ECHO_TIMEOUT_NS
+
+    def chip_debounce(self, chip_name):
+        """ {line offset: debounce period, us} of the echo lines of a chip with debounce """
+        return {line_offset: station.line_def[line_offset]['debounce_us']
+                for line_offset, station in self.chips[chip_name].items()
+                if station.line_def[line_offset]['debounce_us']}
+
+    def reload(self, handlers=()):
+        """
+        Re-read the config file and apply it between two edge events, or not at all.
+
+        Estimator, base, name, ns_per_cm, [stream] thresholds, [trigger] timing and idle rate, the line bias,
+        debounce and pulse filter change on the fly; the lines stay requested and boxes in progress are kept.
+        Station layout, lines, DB, writer and metrics settings need a restart.
+
+        :param handlers: GPIO event handlers to reconfigure the lines of.
+        :return: True if applied.
+        """
+        old_config = self.config
+        try:
+            self.get_config(inline_comment_prefixes=(';', '#'))
+            config = self.config
+            specs = self.station_specs(config)
+            if [spec['name'] for spec in specs] != [station.name for station in self.stations] or \
+                    [spec['chip_name'] for spec in specs] != [station.chip_name for station in self.stations]:
+                raise ValueError('stations changed, restart needed')
+            bias = self.line_bias(config)
+            pulse_filter = self.pulse_filter(config)
+            apply = [station.prepare_reload(config) for station in self.stations]
+        except (ValueError, KeyError, configparser.Error) as exc:
+            self.config = old_config
+            logging.error('config not reloaded: %s', exc)
+            return False
+        for station_apply in apply:
+            station_apply()
+        for station in self.stations:
+            station.pulse_filter = pulse_filter
+        for handler in handlers:
+            handler.reconfigure(bias=bias, debounce=self.chip_debounce(handler.chip_name), pulse_filter=pulse_filter)
+        logging.info('config reloaded')
+        return True
 
     @property
     def chip_name(self):
         """ Returns chip_name from config """
         return self.config['GPIO']['chip_name']
 
+    @property
+    def line_def(self):
+        """ Line definitions of all stations """
+        return {station.name: station.line_def for station in self.stations}
+
+    def chip_callback(self, chip_name):
+        """ Edge event callback dispatching the lines of a chip to their stations """
+        handlers = {line_offset: station.event_handler for line_offset, station in self.chips[chip_name].items()}
+
+        def callback(line_offset, event):
+            handlers[line_offset](line_offset, event)
+        return callback
+
+    def chip_batch_callback(self, chip_name):
+        """ Batch callback passing a read batch of a chip to its stations """
+        stations = list(dict.fromkeys(self.chips[chip_name].values()))
+        if len(stations) == 1:
+            return stations[0].event_batch
+
+        def batch_callback(batch):
+            for station in stations:
+                station.event_batch(batch)
+        return batch_callback
+
+    def chip_resync(self, chip_name):
+        """ Gap callback of a chip """
+        stations = self.chips[chip_name]
+
+        def resync(line_offset, lost):
+            stations[line_offset].resync(line_offset, lost)
+        return resync
+
     def event_handler(self, line_offset, event):
-        # logging.debug(f"Edge detected on line {line_offset}, Event: {event.event_type}")
-        if event.event_type == event.Type.RISING_EDGE:
-            self.timestamp_rising[line_offset] = event.timestamp_ns
-            try:
-                if len(self.dist3[line_offset]) == 2:
-                    self.dist3[line_offset] = []
-            except KeyError:
-                self.dist3[line_offset] = []
-                pass
+        """ Edge event callback for a single chip setup (emulator mode) """
+        self.chips[self.stations[0].chip_name][line_offset].event_handler(line_offset, event)
 
-        elif event.event_type == event.Type.FALLING_EDGE:
-            try:
-                ts_delta = event.timestamp_ns - self.timestamp_rising[line_offset]
-            except KeyError:
-                logging.warning(f'NO rising. Skip: {self.dist3}')
-            else:
-                # if delta 38 ms then NO answer received!
-                # dist_cm = round(ts_delta/1000/58.8, 1)
-                dist_cm = round(ts_delta / 1000 / 57.72, 1)
-                logging.debug(f'   {line_offset}, dist(cm)={dist_cm}')
-                self.dist3[line_offset].append(dist_cm)
-                if len(self.dist3[line_offset]) == 2:
-                    dist_avg = round((self.dist3[line_offset][0] + self.dist3[line_offset][1]) / 2.0, 1)
-                    self.dist3[line_offset] = []
-                    size: float = round(self.line_def[line_offset]['base'] - dist_avg, 1)
-                    self.size[self.line_def[line_offset]['name']] = size
-                    logging.debug(f'{self.line_def[line_offset]["name"]}, dist_avg={dist_avg}, size={size}')
-                    self.timestamp_rising[line_offset] = {}
-                    if len(self.size) == 3:
-                        self.pg_write()
-                        self.size = {}
-
-    def pg_write(self):
-        """ save results to PG database"""
-        logging.debug(self.size)
-        ins_sql = self.curs.mogrify(INS_R3D, (1, self.size['length'], self.size['width'], self.size['height']))
-        self.do_query(ins_sql, reconnect=True)
-
-
-def main():
-    """ Just main
+    def start_trigger(self):
+        """ Start the trigger schedulers of the stations, return the started ones """
+        return [trigger for trigger in (station.start_trigger() for station in self.stations) if trigger is not None]
+
+    @property
+    def line_stats(self):
+        """ Per station, per line counters of echoes, timeouts and unpaired edges """
+        return {station.name: station.line_stats for station in self.stations}
+
+    LINE_COUNTERS = (
+        ('echoes', 'ruler3d_echoes_total', 'Echoes measured'),
+        ('timeouts', 'ruler3d_missed_echoes_total', 'Echo pulses of 38 ms and longer, no echo received'),
+        ('dup_rising', 'ruler3d_rising_without_falling_total', 'Rising edges lost their falling edge'),
+        ('no_rising', 'ruler3d_falling_without_rising_total', 'Falling edges without a rising edge'),
+        ('outliers', 'ruler3d_outliers_total', 'Echoes rejected by the estimator'),
+        ('lost', 'ruler3d_lost_events_total', 'Edge events lost by the kernel event FIFO'),
+    )
+    WRITER_COUNTERS = (
+        ('enqueued', 'ruler3d_records_total', 'Records handed to the writer'),
+        ('dropped', 'ruler3d_records_dropped_total', 'Records dropped, writer queue full'),
+        ('written', 'ruler3d_records_written_total', 'Records committed to PG'),
+        ('failed', 'ruler3d_db_failures_total', 'Failed PG writes, each one is retried'),
+    )
+
+    def setup_metrics(self, handlers):
+        """ Start the metrics endpoint if enabled in config
+
+        :param handlers: The GPIO event handlers to time callbacks of.
+        :return: r3d_metrics.MetricsServer or None.
+        """
+        if not self.config.getboolean('metrics', 'enabled', fallback=False):
+            return None
+        import r3d_metrics
+
+        registry = r3d_metrics.Registry()
+        callback_duration = registry.histogram('ruler3d_callback_seconds', 'Edge event callback duration', scale=1e9)
+        wakeup_latency = registry.histogram('ruler3d_wakeup_latency_seconds',
+                                            'Time from an edge to the listener reading it', scale=1e9)
+        for handler in handlers:
+            handler.callback_duration = callback_duration
+            handler.wakeup_latency = wakeup_latency
+        self.writer.latency = registry.histogram('ruler3d_write_latency_seconds',
+                                                 'Time from a complete record to its commit in PG',
+                                                 buckets=r3d_metrics.WRITE_BUCKETS)
+
+        @registry.collector
+        def collect():
+            for key, name, help_text in self.LINE_COUNTERS:
+                yield name, 'counter', help_text, [({'station': station.name, 'axis': state.name}, getattr(state, key))
+                                                   for station in self.stations for state in station.states]
+            stats = self.writer.stats
+            for key, name, help_text in self.WRITER_COUNTERS:
+                yield name, 'counter', help_text, [({}, stats[key])]
+            yield 'ruler3d_writer_queue_depth', 'gauge', 'Records waiting in the writer queue', [
+                ({}, self.writer.queue.qsize())]
+            yield 'ruler3d_journal_backlog', 'gauge', 'Journal records waiting for PG', [({}, stats['backlog'])]
+            last_write = self.writer.last_write
+            yield 'ruler3d_seconds_since_last_write', 'gauge', 'Seconds since the last successful PG write', [
+                ({}, None if last_write is None else round(time.time() - last_write, 3))]
+            yield 'ruler3d_consumer_dropped_total', 'counter', 'Events dropped by slow async consumers', [
+                ({'chip': handler.chip_name}, getattr(handler, 'dropped', 0)) for handler in handlers]
+            yield 'ruler3d_filtered_pulses_total', 'counter', 'Echo pulses dropped by the pulse width filter', [
+                ({'chip': handler.chip_name, 'line': line_offset},
+                 count + self.chips[handler.chip_name][line_offset].filtered[line_offset])
+                for handler in handlers for line_offset, count in handler.filtered.items()]
+            yield 'ruler3d_wakeup_latency_max_seconds', 'gauge', 'Max time from an edge to the listener reading it', [
+                ({'chip': handler.chip_name}, round(handler.wakeup_max_ns / 1e9, 6)) for handler in handlers]
+            yield 'ruler3d_first_edge_seconds', 'gauge', 'Time from process start to the first edge', [
+                ({'chip': handler.chip_name},
+                 None if handler.first_edge_ns is None or PROCESS_START_NS is None
+                 else round((handler.first_edge_ns - PROCESS_START_NS) / 1e9, 3)) for handler in handlers]
+            if self.publisher is not None:
+                yield 'ruler3d_published_total', 'counter', 'Records published to subscribers', [
+                    ({}, self.publisher.stats['published'])]
+                yield 'ruler3d_publish_dropped_total', 'counter', 'Records dropped for slow subscribers', [
+                    ({}, self.publisher.stats['dropped'])]
+                yield 'ruler3d_subscribers', 'gauge', 'Connected subscribers', [
+                    ({}, len(self.publisher.subscribers))]
+            yield 'ruler3d_scan_bursts_total', 'counter', 'Switches from the idle to the full scan rate', [
+                ({'station': station.name}, station.scan_rate.stats['bursts'])
+                for station in self.stations if station.scan_rate is not None]
+            yield 'ruler3d_records_skipped_total', 'counter', 'Empty table or unchanged box, not recorded', [
+                ({'station': station.name}, station.scan_rate.stats['skipped'])
+                for station in self.stations if station.scan_rate is not None]
+            yield 'ruler3d_pings_total', 'counter', 'Trigger pulses sent', [
+                ({'station': station.name}, station.trigger.stats['pings'])
+                for station in self.stations if station.trigger is not None]
+
+        return r3d_metrics.MetricsServer(registry,
+                                         host=self.config.get('metrics', 'host', fallback='127.0.0.1'),
+                                         port=self.config.getint('metrics', 'port', fallback=9711))
+
+    def stop(self):
+        """ Stop the stations and flush the writer """
+        for station in self.stations:
+            station.stop()
+        self.writer.stop()
+
+
+async def run(ruler3d, record=None):
+    """ Run the ruler3d until SIGINT/SIGTERM
+
+    :param record: File name to record raw edge events to.
     """
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    recorder = None
+    if record:
+        import r3d_record
+
+        recorder = r3d_record.EdgeRecorder(record)
+
+    event_buffer_size = ruler3d.config.getint('GPIO', 'event_buffer_size', fallback=None)
+    max_events = ruler3d.config.getint('GPIO', 'max_events', fallback=None)
+    split = ruler3d.config.getboolean('GPIO', 'split', fallback=False)
+    bias = ruler3d.line_bias(ruler3d.config)
+    pulse_filter = ruler3d.pulse_filter(ruler3d.config)
+    batch = ruler3d.config.getboolean('GPIO', 'batch', fallback=False)
+    realtime = None
+    if ruler3d.config.getboolean('realtime', 'enabled', fallback=False):
+        import r3d_realtime
+
+        realtime = r3d_realtime.options(ruler3d.config)
+    if batch and recorder is not None:
+        logging.warning('recording edge events, batch mode off')
+        batch = False
+    handlers = []
+    for chip_idx, (chip_name, lines) in enumerate(ruler3d.chips.items()):
+        callback = ruler3d.chip_callback(chip_name)
+        batch_callback = ruler3d.chip_batch_callback(chip_name) if batch else None
+        chip_recorder = recorder.for_chip(chip_idx) if recorder is not None else None
+        if split:
+            # the acquisition process opens the chip
+            handlers.append(ShmEventHandler(chip_name=chip_name, line_numbers=tuple(lines), callback=callback,
+                                            gap_callback=ruler3d.chip_resync(chip_name), bias=bias,
+                                            debounce=ruler3d.chip_debounce(chip_name), pulse_filter=pulse_filter,
+                                            batch_callback=batch_callback, recorder=chip_recorder))
+        else:
+            try:
+                handler = AsyncGPIOEventHandler(chip_name=chip_name, line_numbers=tuple(lines), edge_type="both",
+                                                callback=callback, event_buffer_size=event_buffer_size,
+                                                max_events=max_events, gap_callback=ruler3d.chip_resync(chip_name),
+                                                bias=bias, debounce=ruler3d.chip_debounce(chip_name),
+                                                pulse_filter=pulse_filter, batch_callback=batch_callback,
+                                                recorder=chip_recorder)
+            except FileNotFoundError as exc:
+                raise ChipNotFoundError(f'GPIO chip {chip_name} not found') from exc
+            handlers.append(handler)
+    acquisition = None
+    if split:
+        import r3d_shm
+
+        cpu = ruler3d.config.getint('GPIO', 'acquire_cpu', fallback=-1)
+        acquisition = r3d_shm.SplitAcquisition(handlers,
+                                               capacity=ruler3d.config.getint('GPIO', 'ring_size', fallback=65536),
+                                               event_buffer_size=event_buffer_size, max_events=max_events,
+                                               cpu=cpu if cpu >= 0 else None, bias=bias, realtime=realtime)
+        acquisition.start()
+    if ruler3d.publisher is not None:
+        ruler3d.publisher.start(loop)
+    # SIGHUP (systemctl reload) applies config changes without releasing the lines
+    loop.add_signal_handler(signal.SIGHUP, ruler3d.reload, handlers)
+    triggers = ruler3d.start_trigger()
+    metrics = ruler3d.setup_metrics(handlers)
+    if realtime is not None:
+        # last: the writer, metrics and scale threads are started and keep the normal priority
+        r3d_realtime.prewarm(ruler3d.stations)
+        r3d_realtime.apply(**realtime)
+    try:
+        await stop_event.wait()
+        logging.info('stop requested')
+    finally:
+        for trigger in triggers:
+            await trigger.aclose()
+        if acquisition is not None:
+            await acquisition.aclose(timeout=ruler3d.config.getfloat('GPIO', 'stop_timeout', fallback=1.0))
+        else:
+            for handler in handlers:
+                await handler.aclose(timeout=ruler3d.config.getfloat('GPIO', 'stop_timeout', fallback=1.0))
+        if recorder is not None:
+            recorder.close()
+        if ruler3d.publisher is not None:
+            ruler3d.publisher.close()
+        if metrics is not None:
+            metrics.stop()
+        for handler in handlers:
+            logging.info('%s: max wakeup latency %.1f us', handler.chip_name, handler.wakeup_max_ns / 1000)
 
 
 # Example usage
 if __name__ == "__main__":
-    import logging
     import sys
 
     # log_app.PARSER.add_argument('--uuid', type=str, help='an order uuid to check status')
+    log_app.PARSER.add_argument('--record', type=str, help='record raw edge events to a file')
+    log_app.PARSER.add_argument('--replay', type=str, help='process recorded edge events instead of GPIO')
+    log_app.PARSER.add_argument('--replay-speed', type=float, default=0.0,
+                                help='replay speed, 1.0 is real time, 0 (default) as fast as possible')
     ARGS = log_app.PARSER.parse_args()
     print(ARGS)
     RULER3D = Ruler3D(args=ARGS)
@@ -185,13 +926,21 @@ if __name__ == "__main__":
         # logging.debug('lines tuple=%s', RULER3D.lines)
 
         try:
-            HANDLER = GPIOEventHandler(chip_name=RULER3D.chip_name, line_numbers=RULER3D.lines, edge_type="both",
-                                       callback=RULER3D.event_handler)
-        except FileNotFoundError:
-            HANDLER = None
-            logging.error("GPIO chip not found, run in EMU mode")
+            if ARGS.replay:
+                import r3d_record
+
+                # the same seqno checks, resync and pulse filter as live
+                REPLAY = [ReplayEventHandler(chip_name, tuple(lines), RULER3D.chip_callback(chip_name),
+                                             gap_callback=RULER3D.chip_resync(chip_name),
+                                             pulse_filter=RULER3D.pulse_filter(RULER3D.config))
+                          for chip_name, lines in RULER3D.chips.items()]
+                r3d_record.replay(ARGS.replay, [handler._dispatch for handler in REPLAY], speed=ARGS.replay_speed)
+            else:
+                asyncio.run(run(RULER3D, record=ARGS.record))
+        except ChipNotFoundError as exc:
+            logging.error("%s, run in EMU mode", exc)
             # run emulator mode
-            for emu_line in RULER3D.lines:
+            for emu_line in RULER3D.stations[0].lines:
                 for cnt in [0, 1]:
                     # gpiod._ext.EDGE_EVENT_TYPE_RISING,
                     RULER3D.event_handler(emu_line,
@@ -213,14 +962,7 @@ if __name__ == "__main__":
         except PermissionError:
             logging.error("Permission denied")
             sys.exit(1)
-        else:
-            try:
-                while True:
-                    pass  # Keep the program running
-                    time.sleep(1)
-                    # print('loop')
-            except KeyboardInterrupt:
-                print('\ncaught keyboard interrupt!')
-                if HANDLER is not None:
-                    HANDLER.stop()
-                print("Program terminated")
+        finally:
+            RULER3D.stop()
+            logging.info('line stats: %s', RULER3D.line_stats)
+        print("Program terminated")